@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
-import sys, re, copy, itertools
+import sys, os, io, re, csv, copy, json, time, heapq, struct, hashlib, weakref, argparse, threading, itertools, collections, concurrent.futures
+import numpy as np
+
+MISSING = -1    # marker for unobserved variables in batch_ask
+BOOLEAN = ['f', 't']    # states of boolean variables
+BNCMAGIC = b'BNC2'      # first bytes of compiled network files
+
+# Integer indexes of the structure of a network, see Net.buildindexes
+Graph = collections.namedtuple('Graph', ['names', 'ids', 'parents', 'children', 'order', 'ancestors'])
 
 class Net:
     """
@@ -10,10 +18,15 @@ class Net:
         dictionary that maps variable names to a dictonary {
                 parents -> list of parents
                 children -> list of children
-                prob -> probability of the variable if it's independent, else None
-                condprob -> dictionary for the conditionary probability table {
-                        tuple of values for parents -> probability
-                    }
+                states -> list of the names of the values of the variable,
+                    BOOLEAN ['f', 't'] for boolean variables
+                cpt -> contiguous numpy array for the conditional probability
+                    table, with one axis per parent followed by one axis for
+                    the variable itself, indexed by the positions of the values
+                    in `states`; cpt.reshape(-1, len(states)) has one row per
+                    configuration of the parents in mixed radix. It is
+                    read-only, so that cached answers stay valid; change it
+                    with setcpt or setprob.
             }
 
         e.g. for ex2.bn
@@ -21,8 +34,8 @@ class Net:
             'A': {
                 'parents': [],
                 'children': ['C', 'D'],
-                'prob': 0.3,
-                'condprob': {}
+                'states': ['f', 't'],
+                'cpt': array([0.7, 0.3])
             },
             
             ...
@@ -30,76 +43,343 @@ class Net:
             'D': {
                 'parents': ['A', 'B'],
                 'children': [],
-                'prob': -1,
-                'condprob': {
-                    (True, True): 0.7,
-                    (True, False): 0.8,
-                    ...
-                }
+                'states': ['f', 't'],
+                'cpt': array of shape (2, 2, 2), cpt[1, 0, 1] == 0.8
+                    for P(D=t | A=t, B=f)
             }
         }
+
+    The structure is also indexed by integers in `graph`, see buildindexes.
+
+    Values of boolean variables are given as True/False, values of other
+    variables by the names of their states; indices into `states` are
+    accepted for any variable.
+
+    File format: a variable without parents is a single line with the
+    probability that it is true, a variable with parents is a table with one
+    row per configuration of the parents. Variables that are not boolean
+    declare their states after their name, and give the probability of each
+    state:
+
+        P(A) = 0.3
+
+        P(W = sun rain snow) = 0.6 0.3 0.1
+
+        A W | C
+        -------
+        t sun | 0.8
+        ...
+
+        A | R = low mid high
+        --------------------
+        t | 0.2 0.3 0.5
+        f | 0.6 0.3 0.1
     """
-    def __init__(self, fname):
+    def __init__(self, fname, trace=None, compiled=False):
         """
         Initialize the network; read and parse the given file.
 
         Args:
-            fname:  Name of the file containing the data.
+            fname:  Name of the file containing the data, or None for an empty
+                    network to be filled with `read`. Files ending in .bnc are
+                    loaded as compiled networks, see dumpcompiled.
+            trace:  Optional callback `trace(msg, *args)` receiving the steps of
+                    the inference algorithms, e.g. `logging.getLogger().debug`
+                    or `printtrace`. Nothing is traced by default.
+                    Similarly `profile`, set after construction, receives the
+                    QueryStats of each elim_ask query.
+            compiled:   Load the network from the compiled form of the file,
+                    `fname` + 'c', if it is up to date and write it otherwise,
+                    see readcached.
         """
-        self.permutationsmemo = {}
+        self.trace = trace
+        self.profile = None     # callback profile(QueryStats) of elim_ask
+        self.plans = collections.OrderedDict()  # (X, evidence variables) -> QueryPlan
+        self.maxplans = 128
+        self.heuristic = 'greedy'   # elimination ordering, see compile
+        self.pruning = True         # drop variables irrelevant to queries, see relevant
+        self.results = None         # ResultCache of the answers of enum_ask and elim_ask
+        self.logspace = False       # run enum_ask and elim_ask on logarithms, see logcpt
+        self.maxfactor = None       # entries allowed in a factor of elim_ask, see cutset_ask
+        self.maxconditions = 1024   # assignments of a cutset allowed by cutset_ask
+        self.trees = weakref.WeakSet()  # junction trees to update when a CPT changes
         self.net = {}
-        lines = []  # buffer
-        with open(fname) as f:
-            for line in f:
-                if line == '\n':
-                    # parse the buffer if encounter a blank line
-                    self._parse(lines)
-                    lines = []
-                else:
-                    lines.append(line)
-        # there is no blank line at the end of file
-        # but we still have to parse the last block/buffer
-        if len(lines) != 0:
-            self._parse(lines)
+        if fname is None:
+            self.buildindexes()
+        elif fname.endswith('.bnc'):
+            self.loadcompiled(fname)
+        elif compiled:
+            self.readcached(fname)
+        else:
+            with open(fname) as f:
+                self.read(f)
 
+    def read(self, f):
+        """
+        Read and parse the nodes of a network.
 
-    def _parse(self, lines):
+        Args:
+            f:  File, or iterable of the lines of the network.
         """
-        Parse the line(s) comprising a node and add the data to the net.
+        text = f.read() if hasattr(f, 'read') else ''.join(f)
+        # nodes are separated by blank lines
+        for block in re.split(r'\n[ \t\r]*\n', text):
+            lines = block.strip().splitlines()
+            if len(lines) != 0:
+                self._parse(lines)
+        self.buildindexes()
+
+    def readcached(self, fname):
+        """
+        Load the compiled form of a network file, fname + 'c'. It is used if
+        it was written for a file with the same modification time and size or,
+        failing that, the same SHA-1 hash; otherwise the file is parsed and
+        the compiled form is written again. The compiled form is only a cache:
+        a corrupt one is ignored, and one that cannot be written is skipped.
 
         Args:
-            lines:  Buffer/list of lines.
+            fname:  Name of the .bn file.
         """
-        if len(lines) == 1:
-            # single line node/buffer
-            match = re.match(r'P\((.*)\) = (.*)\n', lines[0])
-            var, prob = match.group(1).strip(), float(match.group(2).strip())
-            self.net[var] = {
-                'parents': [], 
-                'children': [],
-                'prob': prob,
-                'condprob': {}
-            }
-        else:
-            # multi line node/buffer
-            # table header
-            match = re.match(r'(.*) \| (.*)', lines[0])
-            parents, var = match.group(1).split(), match.group(2).strip()
+        cname = fname + 'c'
+        stat = os.stat(fname)
+        try:
+            source = self._readheader(cname)[0]['source']
+        except (OSError, ValueError, KeyError, struct.error):
+            source = None
+
+        def load():
+            try:
+                self.loadcompiled(cname)
+                return True
+            except (OSError, ValueError, KeyError, struct.error):
+                self.net = {}
+                return False
+
+        if source is not None and (source['mtime'], source['size']) == (stat.st_mtime_ns, stat.st_size):
+            if load():
+                return
+
+        with open(fname, 'rb') as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        if source is None or source['sha1'] != sha1 or not load():
+            self.read(io.StringIO(data.decode()))
+        try:
+            self.dumpcompiled(cname, {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': sha1})
+        except OSError:
+            pass
+
+    def dumpcompiled(self, cname, source=None):
+        """
+        Write the network in compiled form: BNCMAGIC, the length of the header
+        as a little-endian 64-bit integer, the JSON header describing the
+        variables, with null states for boolean variables, then the CPTs as
+        little-endian doubles, 8-byte aligned so that they can be mapped into
+        memory.
+
+        Args:
+            cname:  Name of the file, conventionally ending in .bnc.
+            source: Dictionary {mtime, size, sha1} of the file the network was
+                    read from, checked by readcached.
+        """
+        variables = []
+        offset = 0
+        for v in self.net:
+            variables.append({
+                'name': v,
+                'parents': self.net[v]['parents'],
+                'states': None if self.net[v]['states'] is BOOLEAN else self.net[v]['states'],
+                'offset': offset
+            })
+            offset += self.net[v]['cpt'].size
+        header = json.dumps({'source': source, 'variables': variables}).encode()
+        header += b' ' * (-(len(BNCMAGIC) + 8 + len(header)) % 8)
+
+        # write to a temporary file first so that readers never see half a file
+        tmp = '%s.%d.tmp' % (cname, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(BNCMAGIC)
+                f.write(struct.pack('<Q', len(header)))
+                f.write(header)
+                for v in self.net:
+                    f.write(np.ascontiguousarray(self.net[v]['cpt'], dtype='<f8').tobytes())
+            os.replace(tmp, cname)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _readheader(self, cname):
+        """
+        Read the header of a compiled network.
+
+        Returns:
+            tuple (header dictionary, offset of the CPTs in the file)
+        """
+        with open(cname, 'rb') as f:
+            if f.read(len(BNCMAGIC)) != BNCMAGIC:
+                raise ValueError('%s is not a compiled network' % cname)
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode())
+        return header, len(BNCMAGIC) + 8 + length
+
+    def loadcompiled(self, cname):
+        """
+        Load a network written by dumpcompiled. The CPTs are read-only views
+        of the file mapped into memory.
+
+        Args:
+            cname:  Name of the file.
+        """
+        header, offset = self._readheader(cname)
+        data = np.memmap(cname, dtype='<f8', mode='r', offset=offset).view(np.ndarray)
+        for node in header['variables']:
+            var, parents = node['name'], node['parents']
+            states = BOOLEAN if node['states'] is None else node['states']
+            shape = [len(self.net[p]['states']) for p in parents] + [len(states)]
             for p in parents:
                 self.net[p]['children'].append(var)
             self.net[var] = {
                 'parents': parents,
                 'children': [],
-                'prob': -1,
-                'condprob': {}
+                'states': states,
+                'cpt': data[node['offset']:node['offset'] + int(np.prod(shape))].reshape(shape)
             }
+        self.buildindexes()
+
+    def dumps(self):
+        """
+        Write the network in the format read by `read`.
+
+        Returns:
+            String
+        """
+        blocks = []
+        for v in self.toposort():
+            parents, states, cpt = self.net[v]['parents'], self.net[v]['states'], self.net[v]['cpt']
+            name = v if states is BOOLEAN else '%s = %s' % (v, ' '.join(states))
+            def probs(dist):
+                return repr(float(dist[1])) if states is BOOLEAN else ' '.join(repr(float(p)) for p in dist)
+            if len(parents) == 0:
+                blocks.append('P(%s) = %s\n' % (name, probs(cpt)))
+            else:
+                header = '%s | %s\n' % (' '.join(parents), name)
+                rows = [header, '-' * (len(header) - 1) + '\n']
+                # rows in the order t t, t f, f t, f f for boolean parents
+                ranges = [reversed(range(len(self.net[p]['states']))) if self.net[p]['states'] is BOOLEAN
+                          else range(len(self.net[p]['states'])) for p in parents]
+                for index in itertools.product(*ranges):
+                    rows.append('%s | %s\n' % (
+                            ' '.join(self.net[p]['states'][i] for p, i in zip(parents, index)),
+                            probs(cpt[index])))
+                blocks.append(''.join(rows))
+        return '\n'.join(blocks)
 
-            # table rows/distributions
+
+    def _parse(self, lines):
+        """
+        Parse the line(s) comprising a node and add the data to the net.
+
+        Args:
+            lines:  Buffer/list of lines.
+        """
+        if len(lines) == 1:
+            # single line node/buffer: P(var) = probs
+            head, _, probs = lines[0].rpartition('=')
+            var, states = self._parsevar(head.strip()[2:-1])
+            parents = []
+            rows = [[]]
+            probs = [probs]
+        else:
+            # multi line node/buffer
+            # table header: parents | var
+            head, _, tail = lines[0].partition('|')
+            parents = head.split()
+            var, states = self._parsevar(tail)
+            # table rows/distributions: values of the parents | probs
+            rows, probs = [], []
             for probline in lines[2:]:
-                match = re.match(r'(.*) \| (.*)', probline)
-                truth, prob = match.group(1).split(), float(match.group(2).strip())
-                truth = tuple(True if x == 't' else False for x in truth)
-                self.net[var]['condprob'][truth] = prob
+                values, _, p = probline.partition('|')
+                rows.append(values.split())
+                probs.append(p)
+
+        for p in parents:
+            self.net[p]['children'].append(var)
+        shape = [len(self.net[p]['states']) for p in parents] + [len(states)]
+        cpt = np.zeros(shape)
+
+        # position of each row in the table: the configuration of the parents
+        # in mixed radix
+        configs = np.zeros(len(rows), dtype=np.intp)
+        for j, p in enumerate(parents):
+            positions = dict((x, i) for i, x in enumerate(self.net[p]['states']))
+            configs = configs * shape[j] + [positions[values[j]] for values in rows]
+        probs = np.array(' '.join(probs).split(), dtype=float).reshape(len(rows), -1)
+        if states is BOOLEAN:
+            probs = np.hstack([1 - probs, probs])
+        cpt.reshape(-1, len(states))[configs] = probs
+        cpt.flags.writeable = False
+
+        self.net[var] = {
+            'parents': parents,
+            'children': [],
+            'states': states,
+            'cpt': cpt
+        }
+
+    def _parsevar(self, s):
+        """
+        Parse a variable name, optionally followed by `= state1 state2 ...`.
+
+        Returns:
+            tuple (name, list of states)
+        """
+        name, _, states = s.partition('=')
+        return name.strip(), states.split() if states.strip() else BOOLEAN
+
+    def index(self, var, value):
+        """
+        Position of a value of a variable in its states.
+
+        Args:
+            var:    The variable.
+            value:  True/False, name of a state or position of the state.
+
+        Returns:
+            Integer
+        """
+        return self.net[var]['states'].index(value) if isinstance(value, str) else int(value)
+
+    def cardinalities(self):
+        """
+        Number of values of each variable.
+
+        Returns:
+            Dictionary {variable: number of states}
+        """
+        return dict((v, len(self.net[v]['states'])) for v in self.net)
+
+    def statename(self, var, value):
+        """
+        Name of a value of a variable, e.g. 't' for True.
+
+        Args:
+            var:    The variable.
+            value:  True/False, name of a state or position of the state.
+
+        Returns:
+            String
+        """
+        return self.net[var]['states'][self.index(var, value)]
+
+    def value(self, var, index):
+        """
+        Value of a variable at a position of its states, True/False for
+        boolean variables and the name of the state otherwise.
+        """
+        states = self.net[var]['states']
+        return bool(index) if states is BOOLEAN else states[index]
 
     def normalize(self, dist):
         """
@@ -113,24 +393,366 @@ class Net:
         """
         return tuple(x * 1/(sum(dist)) for x in dist)
 
+    def lognormalize(self, logdist):
+        """
+        Normalize probability values given by their logarithms.
+
+        Args:
+            logdist:    List of logarithms of probability values.
+
+        Returns:
+            Tuple of normalized values.
+        """
+        total = logsumexp(np.asarray(logdist))
+        if total == -np.inf:
+            raise ZeroDivisionError('the evidence has probability 0')
+        return tuple(np.exp(np.asarray(logdist) - total).tolist())
+
+    def logcpt(self, var):
+        """
+        Logarithms of the CPT of a variable, computed once.
+
+        Returns:
+            Read-only numpy array, -inf for probabilities 0
+        """
+        logcpt = self.logcpts.get(var)
+        if logcpt is None:
+            with np.errstate(divide='ignore'):
+                logcpt = np.log(self.net[var]['cpt'])
+            logcpt.flags.writeable = False
+            self.logcpts[var] = logcpt
+        return logcpt
+
+    def buildindexes(self):
+        """
+        Index the structure of the network once it is read: variables are
+        numbered alphabetically, and `self.graph` holds the Graph of
+            names -> tuple of the variables by number
+            ids -> dictionary {variable: number}
+            parents -> tuple of the tuples of the numbers of the parents
+            children -> tuple of the tuples of the numbers of the children
+            order -> tuple of the variables in topological order, see toposort
+            ancestors -> tuple of bitsets (integers) of the numbers of the
+                ancestors of each variable, including itself
+        """
+        names = tuple(sorted(self.net.keys()))
+        ids = dict((v, i) for i, v in enumerate(names))
+        parents = tuple(tuple(ids[p] for p in self.net[v]['parents']) for v in names)
+        children = tuple(tuple(ids[c] for c in self.net[v]['children']) for v in names)
+
+        # Kahn's algorithm; the original sort repeatedly swept the variables in
+        # alphabetical order, adding those whose parents were all added. A
+        # variable becoming ready when i is added goes in the same sweep as i
+        # if it comes after i alphabetically, else in the next one, so the
+        # variables are taken by (sweep, name).
+        remaining = [len(ps) for ps in parents]
+        heap = [(0, i) for i in range(len(names)) if remaining[i] == 0]
+        order = []
+        ancestors = [0] * len(names)
+        while len(heap) > 0:
+            sweep, i = heapq.heappop(heap)
+            order.append(i)
+            ancestors[i] = 1 << i
+            for p in parents[i]:
+                ancestors[i] |= ancestors[p]
+            for c in children[i]:
+                remaining[c] -= 1
+                if remaining[c] == 0:
+                    heapq.heappush(heap, (sweep if c > i else sweep + 1, c))
+
+        self.graph = Graph(names, ids, parents, children,
+                           tuple(names[i] for i in order), tuple(ancestors))
+        self.digest = None
+        self.digests = {}
+        self.logcpts = {}
+
+    def fingerprint(self):
+        """
+        Digest of the variables and CPTs of the network, which networks read
+        from the same data share. It is computed once, as the CPTs are
+        read-only.
+
+        Returns:
+            Hexadecimal string
+        """
+        if self.digest is None:
+            h = hashlib.sha1()
+            for v in self.graph.names:
+                # digest of each variable, so that only the changed ones are
+                # hashed again after setcpt
+                if v not in self.digests:
+                    node = self.net[v]
+                    d = hashlib.sha1(json.dumps([v, node['parents'], node['states']]).encode())
+                    d.update(np.ascontiguousarray(node['cpt'], dtype='<f8').tobytes())
+                    self.digests[v] = d.digest()
+                h.update(self.digests[v])
+            self.digest = h.hexdigest()
+        return self.digest
+
+    def setcpt(self, var, cpt):
+        """
+        Replace the conditional probability table of a variable in place.
+        Elimination plans stay valid, answers cached for the old table are no
+        longer used as the fingerprint changes, and junction trees of the
+        network only recompute the messages that depend on the table.
+
+        Args:
+            var:    The variable.
+            cpt:    Array of the shape of the CPT of var, see Net, or for a
+                    boolean variable of the shape of its parents, giving the
+                    probabilities that var is true.
+        """
+        node = self.net[var]
+        cpt = np.array(cpt, dtype=float)
+        if node['states'] is BOOLEAN and cpt.shape == node['cpt'].shape[:-1]:
+            cpt = np.stack([1 - cpt, cpt], axis=-1)
+        if cpt.shape != node['cpt'].shape:
+            raise ValueError('CPT of %s has shape %s, not %s' % (var, cpt.shape, node['cpt'].shape))
+        if (cpt < 0).any() or not np.allclose(cpt.sum(axis=-1), 1.0):
+            raise ValueError('CPT of %s is not a distribution for each configuration of its parents' % var)
+        cpt.flags.writeable = False
+        node['cpt'] = cpt
+        self.digests.pop(var, None)
+        self.logcpts.pop(var, None)
+        self.digest = None
+        for tree in list(self.trees):
+            tree.update(var)
+
+    def learn(self, data, alpha=0.0, chunksize=100000):
+        """
+        Learn the CPTs of the network from fully observed data, keeping its
+        structure: each CPT row is the distribution of the counts of the
+        values of the variable, plus `alpha`, over the rows of the data with
+        the configuration of its parents. Rows are read and counted
+        `chunksize` at a time, so the data does not have to fit in memory.
+        Configurations of the parents without data get uniform distributions.
+
+        Args:
+            data:       File name of a CSV file, or file object, with a header
+                        naming the variables and one row per observation;
+                        values are names of states, or t/f, true/false or 1/0
+                        for boolean variables. Other columns are ignored.
+            alpha:      Pseudo-count of each value, the parameter of a
+                        symmetric Dirichlet prior: 0 for maximum likelihood, 1
+                        for Laplace smoothing.
+            chunksize:  Number of rows counted at a time.
+
+        Returns:
+            Number of rows of data
+
+        Raises:
+            ValueError if alpha is negative or the data is malformed or has
+            no rows; the CPTs are then left unchanged.
+        """
+        if not alpha >= 0:
+            raise ValueError('Pseudo-count %r is negative' % alpha)
+        if isinstance(data, str):
+            with open(data, newline='') as f:
+                return self.learn(f, alpha, chunksize)
+
+        reader = csv.reader(data)
+        header = [h.strip() for h in next(reader, [])]
+        missing = [v for v in sorted(self.net) if v not in header]
+        if len(missing) > 0:
+            raise ValueError('No column for %s' % ', '.join(missing))
+        columns = dict((v, header.index(v)) for v in self.net)
+        codes = {}
+        for v in self.net:
+            codes[v] = dict((s, i) for i, s in enumerate(self.net[v]['states']))
+            if self.net[v]['states'] is BOOLEAN:
+                codes[v].update({'false': 0, 'true': 1, '0': 0, '1': 1, 'F': 0, 'T': 1, 'False': 0, 'True': 1})
+        counts = dict((v, np.zeros(self.net[v]['cpt'].size, dtype=np.int64)) for v in self.net)
+
+        rows = 0
+        while True:
+            chunk = list(itertools.islice(reader, chunksize))
+            if len(chunk) == 0:
+                break
+            table = np.array(chunk, dtype=str)
+            if table.ndim != 2 or table.shape[1] != len(header):
+                raise ValueError('Rows after line %d do not have %d columns' % (rows + 1, len(header)))
+            # positions of the values: each distinct string is looked up once
+            values = {}
+            for v in self.net:
+                uniques, inverse = np.unique(np.char.strip(table[:, columns[v]]), return_inverse=True)
+                unknown = [u for u in uniques if u not in codes[v]]
+                if len(unknown) > 0:
+                    raise ValueError('Unknown value %r of %s after line %d' % (str(unknown[0]), v, rows + 1))
+                values[v] = np.array([codes[v][u] for u in uniques], dtype=np.intp)[inverse.ravel()]
+            for v in self.net:
+                node = self.net[v]
+                index = np.ravel_multi_index([values[p] for p in node['parents']] + [values[v]], node['cpt'].shape)
+                counts[v] += np.bincount(index, minlength=counts[v].size)
+            rows += len(chunk)
+        if rows == 0:
+            raise ValueError('No rows of data')
+
+        # all the tables are made before any is set
+        cpts = {}
+        for v in sorted(self.net):
+            shape = self.net[v]['cpt'].shape
+            pseudo = counts[v].reshape(shape) + alpha
+            totals = pseudo.sum(axis=-1, keepdims=True)
+            cpts[v] = np.where(totals > 0, pseudo / np.where(totals > 0, totals, 1), 1.0 / shape[-1])
+        for v in sorted(cpts):
+            self.setcpt(v, cpts[v])
+        return rows
+
+    def setprob(self, var, parents, dist):
+        """
+        Replace the distribution of a variable given one configuration of its
+        parents, see setcpt.
+
+        Args:
+            var:        The variable.
+            parents:    Dictionary of the values of the parents of var.
+            dist:       Distribution over the states of var, or the probability
+                        that var is true for a boolean variable.
+        """
+        node = self.net[var]
+        dist = np.array(dist, dtype=float)
+        if node['states'] is BOOLEAN and dist.ndim == 0:
+            dist = np.array([1 - dist, dist])
+        cpt = node['cpt'].copy()
+        cpt[tuple(self.index(p, parents[p]) for p in node['parents'])] = dist
+        self.setcpt(var, cpt)
+
+    def resultkey(self, alg, X, e):
+        """
+        Key of the answer of a query in the result cache, the same whatever
+        the order of the evidence or the form of its values.
+        """
+        return (self.fingerprint(), alg, X, tuple(sorted((v, self.index(v, e[v])) for v in e)))
+
     def toposort(self):
         """
         Run a topological sort to determine the order of the variables.
         All parents of a node has to be added before the node is added, and ties
         are broken alphabetically.
         """
-        variables = list(self.net.keys())
-        variables.sort()
-        s = set()   # used to mark variables
-        l = []
-        while len(s) < len(variables):
-            for v in variables:
-                if v not in s and all(x in s for x in self.net[v]['parents']):
-                    # add the variable `v` into the set `s` iff
-                    # all parents of `v` are already in `s`.
-                    s.add(v)
-                    l.append(v)
-        return l
+        return list(self.graph.order)
+
+    def ancestors(self, variables):
+        """
+        Find the ancestors of the given variables.
+
+        Args:
+            variables:  Iterable of variables.
+
+        Returns:
+            Set of the variables and all their ancestors.
+        """
+        return self.members(self.ancestorbits(variables))
+
+    def ancestorbits(self, variables):
+        """
+        Bitset of the ancestors of the given variables, including them.
+        """
+        bits = 0
+        for v in variables:
+            bits |= self.graph.ancestors[self.graph.ids[v]]
+        return bits
+
+    def members(self, bits):
+        """
+        Variables of a bitset.
+        """
+        names = self.graph.names
+        found = set()
+        while bits:
+            low = bits & -bits
+            found.add(names[low.bit_length() - 1])
+            bits ^= low
+        return found
+
+    def dseparated(self, X, Y, Z):
+        """
+        Check whether the variables X and Y are d-separated by Z, i.e. they
+        are disconnected in the moral graph of the ancestors of X, Y and Z once
+        Z is removed.
+
+        Args:
+            X, Y, Z:    Disjoint sets of variables.
+
+        Returns:
+            True if X and Y are independent given Z.
+        """
+        ancestors = self.ancestors(set(X) | set(Y) | set(Z))
+        graph = dict((v, set()) for v in ancestors)
+        for v in ancestors:
+            family = self.net[v]['parents'] + [v]
+            for a, b in itertools.combinations(family, 2):
+                graph[a].add(b)
+                graph[b].add(a)
+        visited = set(X)
+        stack = list(X)
+        while len(stack) > 0:
+            for v in graph[stack.pop()]:
+                if v in Y:
+                    return False
+                if v not in visited and v not in Z:
+                    visited.add(v)
+                    stack.append(v)
+        return True
+
+    def relevant(self, X, evidence):
+        """
+        Find the part of the network that a query depends on: evidence
+        variables d-separated from X by the rest of the evidence are dropped,
+        then only the ancestors of X and of the remaining evidence are kept.
+
+        Args:
+            X:          The query variable.
+            evidence:   Iterable of the names of the evidence variables.
+
+        Returns:
+            tuple (set of relevant variables, set of relevant evidence variables)
+        """
+        evidence = set(evidence)
+        for v in sorted(evidence):
+            if self.dseparated({X}, {v}, evidence - {v}):
+                evidence.remove(v)
+        return self.ancestors(evidence | {X}), evidence
+
+    def subnet(self, variables):
+        """
+        Restrict the network to the given variables, which have to include
+        the parents of each of them. The CPTs are shared with this network.
+
+        Args:
+            variables:  Set of variables.
+
+        Returns:
+            Net
+        """
+        sub = copy.copy(self)
+        sub.net = {}
+        for v in self.net:
+            if v in variables:
+                sub.net[v] = dict(self.net[v])
+                sub.net[v]['children'] = [c for c in self.net[v]['children'] if c in variables]
+        sub.plans = collections.OrderedDict()
+        sub.pruning = False
+        sub.results = None
+        sub.trees = weakref.WeakSet()
+        sub.buildindexes()
+        return sub
+
+    def prune(self, X, e):
+        """
+        Restrict the network to the variables relevant to a query.
+
+        Args:
+            X:  The query variable.
+            e:  Dictionary of evidence variables and observed values.
+
+        Returns:
+            tuple (Net, dictionary of the relevant evidence)
+        """
+        variables, evidence = self.relevant(X, e)
+        if self.trace is not None:
+            self.trace('Pruned %d of %d variables', len(self.net) - len(variables), len(self.net))
+        return self.subnet(variables), dict((v, x) for v, x in e.items() if v in evidence)
 
     def querygiven(self, Y, e):
         """
@@ -141,7 +763,7 @@ class Net:
         Args:
             Y:  The variable for which we calculate the probability distribution.
             e:  The evidence set in the form of a dictionary 
-                    { string name: boolean value }, extended with the value of Y.
+                    { string name: value }, extended with the value of Y.
 
         Returns:
             A single double representing the probability that Y has the specified value.
@@ -152,41 +774,9 @@ class Net:
         >>> net.querygiven('A', e)
         0.71
         """
-        # Y has no parents
-        if self.net[Y]['prob'] != -1:
-            prob = self.net[Y]['prob'] if e[Y] else 1 - self.net[Y]['prob']
-
-        # Y has at least 1 parent
-        else:
-            # get the value of parents of Y
-            parents = tuple(e[p] for p in self.net[Y]['parents'])
-
-            # query for prob of Y = y
-            prob = self.net[Y]['condprob'][parents] if e[Y] else 1 - self.net[Y]['condprob'][parents]
-        return prob
-
-    def genpermutations(self, length):
-        """
-        Generate tuples of boolean values that have the specified length.
-
-        Returns:
-            A list of 2^length distinct tuples.
-        """
-        assert(length >= 0)
-        if length in self.permutationsmemo:
-            return self.permutationsmemo[length]
-        else:
-            perms = set()
-            for comb in itertools.combinations_with_replacement([False, True], length):
-                for perm in itertools.permutations(comb):
-                    perms.add(perm)
-            perms = list(perms)
-                # perms = [(False, False, False), (False, False, True), ...]
-            assert(len(perms) == pow(2, length))
-
-            self.permutationsmemo[length] = perms
-            return perms
-
+        # index the table by the values of the parents of Y and of Y
+        index = tuple(self.index(p, e[p]) for p in self.net[Y]['parents'])
+        return float(self.net[Y]['cpt'][index + (self.index(Y, e[Y]),)])
 
     def makefactor(self, var, factorvars, e):
         """
@@ -194,7 +784,9 @@ class Net:
 
         Args:
             var:    The currently selected variable.
-            factorvars: Dictionary of factor variables for the selected var.
+            factorvars: Dictionary of factor variables for the selected var,
+                        the variables among var and its parents that are not
+                        in the evidence set.
             e:      Dictionary of the evidence set
 
         Returns:
@@ -204,50 +796,9 @@ class Net:
                     tuple: tuple of True/False values corresponding to the variables
                     float: probability
         """
-        variables = factorvars[var]
-        variables.sort() 
-        # for 'D' in ex2.bn: ['A', 'D']
-        # This is gonna be the keys for the factor
-        # (True, True): a => A=t, D=t, prob = a
-
-        allvars = copy.deepcopy(self.net[var]['parents'])
-        allvars.append(var)
-        # This is the list of all variables involved including those that are in
-        # the evidence set.
-        # for 'D' in ex2.bn: ['A', 'B', 'D']
-        
-        # Generate the factor entries:
-        # 1. Generate all possible permutations of values of the variables
-        #   e.g. A=t,B=t,D=t; A=t,B=t,D=f; ...
-        
-        perms = self.genpermutations(len(allvars))
-
-        # 2. We take into account the variables that are already in the evidence
-        # set by filtering out permutations that does not conform to the values
-        # that the variables already have.
-        #   e.g. B=t in e then we filter out permutations that have B=f.
-        entries = {}
-        asg = {}
-        for perm in perms:
-            violate = False
-            for pair in zip(allvars, perm): # tuples of ('var', value)
-                if pair[0] in e and e[pair[0]] != pair[1]:
-                    violate = True
-                    break
-                asg[pair[0]] = pair[1]
-
-            if violate:
-                continue
-
-        # 3. Based on the remaining permutations we generate entries for the
-        # factor.
-        #   e.g. A=t,B=t,D=t then we have A=t,D=t with prob 0.7
-        #        A=f,B=t,D=f then we have A=f,D=f with prob 0.9
-            key = tuple(asg[v] for v in variables)
-            prob = self.querygiven(var, asg)
-            entries[key] = prob
-
-        return (variables, entries)
+        factorvars[var].sort()
+        factor = self.cptfactor(var, e)
+        return (factor.variables, factor.todict())
 
     def pointwise(self, var, factor1, factor2):
         """
@@ -255,30 +806,13 @@ class Net:
 
         Args:
             var:    common variable
-            factors:    List of factors
+            factor1, factor2:   Factors in form of ([vars], {entries})
 
         Returns:
-            list of new factors
+            The product in form of ([vars], {entries})
         """
-        newvariables = []
-        newvariables.extend(factor1[0])
-        newvariables.extend(factor2[0])
-        newvariables = list(set(newvariables))
-        newvariables.sort()
-
-        perms = self.genpermutations(len(newvariables))
-        newtable = {}
-        asg = {}
-        for perm in perms:
-            for pair in zip(newvariables, perm):
-                asg[pair[0]] = pair[1]
-            key = tuple(asg[v] for v in newvariables)
-            key1 = tuple(asg[v] for v in factor1[0])
-            key2 = tuple(asg[v] for v in factor2[0])
-            prob = factor1[1][key1] * factor2[1][key2]
-            newtable[key] = prob
-
-        return (newvariables, newtable)
+        product = Factor.fromdict(*factor1).pointwise(Factor.fromdict(*factor2))
+        return (product.variables, product.todict())
 
     def sumout(self, var, factors):
         """
@@ -291,239 +825,2013 @@ class Net:
         Returns:
             A new list of summed out factors.
         """
-        # POINTWISE
-        pwfactors = []  # list of factors containing var
-        indices = []
-        for i, factor in enumerate(factors):
+        # POINTWISE the factors containing var
+        product = None
+        rest = []
+        for factor in factors:
             if var in factor[0]:
-                pwfactors.append(factor)
-                indices.append(i)
-        if len(pwfactors) > 1:
-            for i in reversed(indices):
-                del factors[i]
-            result = pwfactors[0]
-            for factor in pwfactors[1:]:
-                result = self.pointwise(var, result, factor)
-            factors.append(result)
+                factor = Factor.fromdict(*factor)
+                product = factor if product is None else product.pointwise(factor)
+            else:
+                rest.append(factor)
 
         # SUM OUT
-        # for each factor
-        for i, factor in enumerate(factors):
-            # for each variable in the factor's variable list
-            for j, v in enumerate(factor[0]):
-                # if the variable is hidden
-                if v == var:
-
-                    # variable list of the new factor
-                    newvariables = factor[0][:j] + factor[0][j+1:]
-
-                    # probability table of the new factor
-                    newentries = {}
-                    for entry in factor[1]:
-                        entry = list(entry)
-                        newkey = tuple(entry[:j] + entry[j+1:])
-
-                        entry[j] = True
-                        prob1 = factor[1][tuple(entry)]
-                        entry[j] = False
-                        prob2 = factor[1][tuple(entry)]
-                        prob = prob1 + prob2
-                        
-                        newentries[newkey] = prob
-
-                    # replace the old factor
-                    factors[i] = (newvariables, newentries)
-                    if len(newvariables) == 0:
-                        del factors[i]
+        if product is not None:
+            result = product.sumout(var)
+            if len(result.variables) > 0:
+                rest.append((result.variables, result.todict()))
+        factors[:] = rest
         return factors
 
-    def enum_ask(self, X, e):
+    def enum_ask(self, X, e, cache=True):
         """
         Calculate the distribution over the query variable X using enumeration.
 
         Args:
-            X:  The query variable.
-            e:  Dictionary of evidence variables and observed values.
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            cache:  Whether to go through the result cache `self.results`, if
+                    there is one.
 
         Returns:
-            Distribution over X as a tuple (P(X=f | e), P(X=t | e))
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
         """
+        if cache and self.results is not None:
+            return self.results.ask(self.resultkey('enum', X, e), lambda: self.enum_ask(X, e, False))
+        if self.pruning:
+            net, e = self.prune(X, e)
+            return net.enum_ask(X, e)
+
+        # the evidence set is extended in place with the value of X
+        e = dict(e)
+        variables = self.toposort()
         dist = []
-        for x in [False, True]:
-            # make a copy of the evidence set
-            e = copy.deepcopy(e)
-
-            # extend e with value of X
+        for x in range(len(self.net[X]['states'])):
             e[X] = x
-
-            # topological sort
-            variables = self.toposort()
-
-            # enumerate
             dist.append(self.enum_all(variables, e))
 
         # normalize & return
-        return self.normalize(dist)
+        return self.lognormalize(dist) if self.logspace else self.normalize(dist)
 
     def enum_all(self, variables, e):
         """
-        Enumerate over variables.
+        Enumerate over variables, without recursion. The assignment is extended
+        and restored in place, and the sum over the variables from a position
+        on is computed once for each assignment of the earlier variables it
+        depends on.
 
         Args:
             variables:  List of variables, topologically sorted
-            e:          Dictionary of the evidence set in form of 'var': True/False.
+            e:          Dictionary of the evidence set in form of 'var': value.
 
         Returns:
-            probability as a real number
+            probability as a real number, or its logarithm if `self.logspace`
         """
-        if len(variables) == 0:
-            return 1.0
-        Y = variables[0]
-        if Y in e:
-            ret = self.querygiven(Y, e) * self.enum_all(variables[1:], e)
+        n = len(variables)
+        log = self.logspace
+        one, zero = (0.0, -np.inf) if log else (1.0, 0.0)
+
+        # variables before each position that are parents of a variable at or
+        # after it; the sum from that position on only depends on their values
+        position = dict((v, i) for i, v in enumerate(variables))
+        last = [-1] * n  # position of the last variable a variable is a parent of
+        for i, v in enumerate(variables):
+            for p in self.net[v]['parents']:
+                last[position[p]] = max(last[position[p]], i)
+        frontier = [()] * (n + 1)
+        current = []
+        for i in range(n):
+            current.append(i)
+            current = [j for j in current if last[j] > i]
+            frontier[i + 1] = tuple(variables[j] for j in current)
+        evidence = set(e)
+
+        cache = {}
+        stack = []  # frames [position, cache key, values to sum over, branch, sum]
+        i, value = 0, None
+        while True:
+            # go down until the sum is known
+            while value is None:
+                if i == n:
+                    value = one
+                    break
+                key = (i, tuple(e[v] for v in frontier[i]))
+                if key in cache:
+                    value = cache[key]
+                    break
+                Y = variables[i]
+                values = (e[Y],) if Y in evidence else tuple(reversed(range(len(self.net[Y]['states']))))
+                e[Y] = values[0]
+                stack.append([i, key, values, 0, zero])
+                i += 1
+
+            if len(stack) == 0:
+                return value
+
+            # add the branch to the sum of the frame above
+            frame = stack[-1]
+            Y = variables[frame[0]]
+            if log:
+                index = tuple(self.index(p, e[p]) for p in self.net[Y]['parents']) + (self.index(Y, e[Y]),)
+                frame[4] = float(np.logaddexp(frame[4], self.logcpt(Y)[index] + value))
+            else:
+                frame[4] += self.querygiven(Y, e) * value
+            frame[3] += 1
+            if frame[3] < len(frame[2]):
+                e[Y] = frame[2][frame[3]]
+                i, value = frame[0] + 1, None
+            else:
+                stack.pop()
+                if Y not in evidence:
+                    del e[Y]
+                value = cache[frame[1]] = frame[4]
+                if self.trace is not None:
+                    self.trace("%-14s | %-20s = %.8f",
+                            ' '.join(variables[frame[0]:]),
+                            ' '.join('%s=%s' % (v, self.statename(v, e[v])) for v in e),
+                            value)
+
+    def cptfactor(self, var, e, log=False):
+        """
+        Make the factor of the conditional probability table of `var`, reduced
+        by the evidence set.
+
+        Args:
+            var:    The selected variable.
+            e:      Dictionary of the evidence set.
+            log:    Whether to make a factor of the logarithms, see logcpt.
+
+        Returns:
+            Factor over the variables among `var` and its parents that are not
+            in the evidence set, in alphabetical order.
+        """
+        allvars = self.net[var]['parents'] + [var]
+        index = tuple(self.index(v, e[v]) if v in e else slice(None) for v in allvars)
+        variables = [v for v in allvars if v not in e]
+        # move the axes so that the variables are in alphabetical order
+        axes = sorted(range(len(variables)), key=lambda i: variables[i])
+        cpt = self.logcpt(var) if log else self.net[var]['cpt']
+        return Factor([variables[i] for i in axes], np.asarray(cpt[index]).transpose(axes), log)
+
+    def tracefactors(self, factors):
+        """
+        Send the entries of the factors to the trace callback.
+
+        Args:
+            factors:    List of Factor objects.
+        """
+        self.trace('Factors:')
+        for factor in factors:
+            for asg, prob in factor.entries():
+                self.trace('%s: %.4f',
+                        ' '.join('%s=%s' % (k, self.net[k]['states'][i]) for k, i in zip(factor.variables, asg)),
+                        prob)
+            self.trace('')
+
+    def interactiongraph(self, evidence):
+        """
+        Make the interaction graph of the factors reduced by the evidence: the
+        moral graph of the network without the evidence variables.
+
+        Args:
+            evidence:   Iterable of the names of the evidence variables.
+
+        Returns:
+            Dictionary {variable: set of neighbors}
+        """
+        evidence = set(evidence)
+        graph = dict((v, set()) for v in self.net if v not in evidence)
+        for v in self.net:
+            family = [u for u in self.net[v]['parents'] + [v] if u not in evidence]
+            for a, b in itertools.combinations(family, 2):
+                graph[a].add(b)
+                graph[b].add(a)
+        return graph
+
+    def compile(self, X, evidence, heuristic=None, prune=None):
+        """
+        Get the elimination plan for queries over X given values of the
+        evidence variables. Plans are kept in a LRU cache of at most
+        `self.maxplans` entries.
+
+        Args:
+            X:          The query variable.
+            evidence:   Iterable of the names of the evidence variables.
+            heuristic:  Ordering heuristic, 'greedy', one of HEURISTICS or
+                        'auto' for the order with the smallest largest factor;
+                        `self.heuristic` by default.
+            prune:      Whether to eliminate over the relevant variables only,
+                        see relevant; `self.pruning` by default.
+
+        Returns:
+            QueryPlan
+        """
+        heuristic = self.heuristic if heuristic is None else heuristic
+        prune = self.pruning if prune is None else prune
+        key = (X, frozenset(evidence), heuristic, prune)
+        plan = self.plans.get(key)
+        if plan is None:
+            if heuristic == 'auto':
+                plan = min((self.compile(X, key[1], h, prune) for h in ['greedy'] + sorted(HEURISTICS)),
+                           key=lambda p: (p.maxsize, p.width))
+            elif prune:
+                variables, evidence = self.relevant(X, key[1])
+                plan = QueryPlan(self.subnet(variables), X, frozenset(evidence), heuristic)
+                plan.pruned = len(self.net) - len(variables)
+            else:
+                plan = QueryPlan(self, X, key[1], heuristic)
+            self.plans[key] = plan
+            if len(self.plans) > self.maxplans:
+                self.plans.popitem(last=False)
         else:
-            probs = []
-            e2 = copy.deepcopy(e)
-            for y in [True, False]:
-                e2[Y] = y
-                probs.append(self.querygiven(Y, e2) * self.enum_all(variables[1:], e2))
-            ret = sum(probs)
-
-        print("%-14s | %-20s = %.8f" % (
-                ' '.join(variables),
-                ' '.join('%s=%s' % (v, 't' if e[v] else 'f') for v in e),
-                ret
-            ))
-        return ret
-
-    def elim_ask(self, X, e):
+            try:
+                self.plans.move_to_end(key)
+            except KeyError:
+                pass  # evicted meanwhile by a query in another thread
+        return plan
+
+    def elim_ask(self, X, e, cache=True):
         """
         Calculate the distribution over the query variable X using elimination.
 
         Args:
-            X:  The query variable.
-            e:  Dictionary of evidence variables and observed values.
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            cache:  Whether to go through the result cache `self.results`, if
+                    there is one.
 
         Returns:
-            Distribution over X as a tuple (P(X=f | e), P(X=t | e))
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
         """
-        eliminated = set()
-        factors = []
-
-        while len(eliminated) < len(self.net):
-            # 1.determine variable order
-            # a. filter variables whose children have been eliminated
-            # b. count the number of variables in the factor
-            #   - do not count variables that are in the ~~query or~~ evidence set
-            #   - only count the variable itself and its immediate parents
-            # c. sort and break ties alphabetically
-            
-            # filter variables that are eliminated
-            variables = filter(lambda v: v not in eliminated, list(self.net.keys()))
-
-            # filter variables that have some children that have not been eliminated
-            variables = filter(lambda v: all(c in eliminated for c in self.net[v]['children']), 
-                                variables)
-
-            # enumerate the variables in the factor associated with the variable
-            factorvars = {}
-            for v in variables:
-                factorvars[v] = [p for p in self.net[v]['parents'] if p not in e ]#and p != X]
-                if v not in e: #and v != X:
-                    factorvars[v].append(v)
-
-            # sort according to the number of variables in the factor and then alphabetically
-            var = sorted(factorvars.keys(), key=(lambda x: (len(factorvars[x]), x)))[0]
-            print('----- Variable: %s -----' % var)
-
-            # 2. make factor
-            # if all factors contain some var then run pointwise-product?
-            if len(factorvars[var]) > 0:
-                factors.append(self.makefactor(var, factorvars, e))
-
-            # 3. if the selected var is a hidden var (not in the query or evidence
-            #   set), then sum out the factors
-            if var != X and var not in e:
-                factors = self.sumout(var, factors)
-            
-            eliminated.add(var)
-            print('Factors:')
-            for factor in factors:
-                asg = {}
-                perms = list(self.genpermutations(len(factor[0])))
-                perms.sort()
-                for perm in perms:
-                    for pair in zip(factor[0], perm):
-                        asg[pair[0]] = pair[1]
-                    key = tuple(asg[v] for v in factor[0])
-                    print('%s: %.4f' % (
-                            ' '.join('%s=%s' % (k, 't' if asg[k] else 'f') for k in sorted(asg.keys())),
-                            factor[1][key]
-                        ))
-                print()
-        
-        # calculate the pointwise-product then normalize
-        if len(factors) >= 2:
-            result = factors[0]
-            for factor in factors[1:]:
-                result = self.pointwise(var, result, factor)
+        if cache and self.results is not None:
+            return self.results.ask(self.resultkey('elim', X, e), lambda: self.elim_ask(X, e, False))
+        if self.profile is None:
+            stats = None
         else:
-            result = factors[0]
-        return self.normalize((result[1][(False,)], result[1][(True,)]))
+            stats = QueryStats(X, e)
+            start = time.perf_counter()
+        plan = self.compile(X, e)
+        if self.maxfactor is not None and plan.maxsize > self.maxfactor:
+            # try the other orderings, then conditioning, before allocating
+            plan = self.compile(X, e, 'auto')
+            if plan.maxsize > self.maxfactor:
+                if stats is not None:
+                    stats.record('ordering', start)
+                dist = self.cutset_ask(X, e, stats)
+                if stats is not None:
+                    self.profile(stats)
+                return dist
+        if stats is None:
+            return plan.run(self, e)
+
+        stats.record('ordering', start)
+        stats.plan = plan
+        dist = plan.run(self, e, stats)
+        self.profile(stats)
+        return dist
+
+    def cutset_ask(self, X, e, stats=None):
+        """
+        Calculate the distribution over X by conditioning, when eliminating
+        would make factors of more than `self.maxfactor` entries: hidden
+        variables of the largest factor are added to a cutset until the plan
+        with the cutset observed fits, then the unnormalized results for each
+        assignment of the cutset are summed.
 
-def query(fname, alg, q):
-    """
-    Construct the bayes net, query and return distr.
+        Args:
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            stats:  Optional QueryStats, see QueryPlan.run; the search for
+                    the cutset counts as ordering, and the plan is the one run
+                    for each assignment of the cutset.
 
-    Args:
-        fname:  File name of the bayes net
-        alg:    Algorithm to use (enum or elim)
-        q:      Query
-    """
-    # construct the net from the given file name
-    try:
-        net = Net(fname)
-    except:
-        print('Failed to parse %s' % fname)
-        exit()
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
 
-    # parse the given query
-    match = re.match(r'P\((.*)\|(.*)\)', q)
-    if match:
-        X = match.group(1).strip()
-        e = match.group(2).strip().split(',')
-        edict = dict((x[0], True if x[2] == 't' else False) for x in e)
-    else:
-        match = re.match(r'P\((.*)\)', q)
-        X = match.group(1).strip()
-        e = []
-        edict = {}
-     
-    # call the appropriate function
-    dist = net.enum_ask(X, edict) if alg == 'enum' else net.elim_ask(X, edict)
-    print("\nRESULT:")
-    for prob, x in zip(dist, [False, True]):
-        print("P(%s = %s | %s) = %.4f" %
-                (X,
-                't' if x else 'f',
-                ', '.join('%s = %s' % tuple(v.split('=')) for v in e),
-                prob))
+        Raises:
+            MemoryError, before allocating anything, if the cutset would need
+            more than `self.maxconditions` assignments.
+        """
+        if stats is not None:
+            start = time.perf_counter()
+        if self.pruning:
+            # the plans over the cutset must not prune evidence
+            net, e = self.prune(X, e)
+            if stats is not None:
+                stats.record('ordering', start)
+            return net.cutset_ask(X, e, stats)
+
+        card = self.cardinalities()
+        evidence = set(e)
+        cutset = []
+        plan = self.compile(X, evidence, 'auto')
+        while plan.maxsize > self.maxfactor:
+            graph = self.interactiongraph(evidence | set(cutset))
+            candidates = [v for v in plan.largest if v != X and v not in evidence and v not in cutset]
+            if len(candidates) > 0:
+                cutset.append(max(sorted(candidates), key=lambda v: len(graph[v])))
+            if len(candidates) == 0 or np.prod([card[v] for v in cutset]) > self.maxconditions:
+                raise MemoryError('P(%s | %s) needs factors of %d entries, over maxfactor %d, '
+                                  'or more than %d conditions' % (X, ', '.join(sorted(evidence)),
+                                  plan.maxsize, self.maxfactor, self.maxconditions))
+            plan = self.compile(X, evidence | set(cutset), 'auto')
+        if self.trace is not None:
+            self.trace('Conditioning on %s', ' '.join(cutset))
+        if stats is not None:
+            stats.record('ordering', start)
+            stats.plan = plan
+
+        total = None
+        e = dict(e)
+        for values in itertools.product(*(range(card[v]) for v in cutset)):
+            e.update(zip(cutset, values))
+            result = plan.run(self, e, stats, normalize=False)
+            if total is None:
+                total = result
+            else:
+                total = np.logaddexp(total, result) if self.logspace else total + result
+        if stats is not None:
+            start = time.perf_counter()
+        dist = self.lognormalize(total.tolist()) if self.logspace else self.normalize(total.tolist())
+        if stats is not None:
+            stats.record('normalize', start)
+        return dist
+
+    def eliminate(self, order, e, maximize=()):
+        """
+        Eliminate variables from the factors of the CPTs reduced by the
+        evidence, in log space if `self.logspace`.
 
-def main():
-    try:
-        fname = sys.argv[1]
+        Args:
+            order:      List of the variables to eliminate.
+            e:          Dictionary of evidence variables and observed values.
+            maximize:   Set of variables of order to maximize over instead of
+                        summing them out.
+
+        Returns:
+            tuple (list of the factors left, list of (variable, factor of the
+            positions of its maximizing values) in elimination order)
+        """
+        factors = [self.cptfactor(v, e, self.logspace) for v in sorted(self.net)]
+        traceback = []
+        for var in order:
+            take = [f for f in factors if var in f.variables]
+            factors = [f for f in factors if var not in f.variables]
+            product = take[0]
+            for f in take[1:]:
+                product = product.pointwise(f)
+            if var in maximize:
+                factor, argmax = product.maxout(var)
+                factors.append(factor)
+                traceback.append((var, argmax))
+            else:
+                factors.append(product.sumout(var))
+        return factors, traceback
+
+    def joint_ask(self, variables, e, alg='elim'):
+        """
+        Calculate the joint distribution over several query variables, by
+        keeping them all when eliminating the others, or by enumeration.
 
-        alg = sys.argv[2]
-        assert(alg == 'enum' or alg == 'elim')
+        Args:
+            variables:  List of the query variables, not in e.
+            e:          Dictionary of evidence variables and observed values.
+            alg:        'elim' or 'enum'.
+
+        Returns:
+            Dictionary {tuple of the values of the variables: probability},
+            values being True/False for boolean variables and names of states
+            otherwise
+        """
+        variables = list(variables)
+        if any(v in e for v in variables) or len(set(variables)) != len(variables):
+            raise ValueError('Query variables %s overlap' % ', '.join(variables))
+        if self.pruning:
+            net = self.subnet(self.ancestors(set(variables) | set(e)))
+            return net.joint_ask(variables, e, alg)
+
+        card = self.cardinalities()
+        if alg == 'enum':
+            e = dict(e)
+            order = self.toposort()
+            values = []
+            for asg in itertools.product(*(range(card[v]) for v in variables)):
+                e.update(zip(variables, asg))
+                values.append(self.enum_all(order, e))
+            values = np.array(values).reshape([card[v] for v in variables])
+        else:
+            order = triangulate(self.interactiongraph(e), 'minfill', keep=set(variables), card=card)[0]
+            factors, _ = self.eliminate(order, e)
+            product = factors[0]
+            for f in factors[1:]:
+                product = product.pointwise(f)
+            # axes in the order of the query variables
+            values = product.values.transpose([product.variables.index(v) for v in variables])
+
+        values = np.asarray(values, dtype=float)
+        total = logsumexp(values) if self.logspace else values.sum()
+        if total == (-np.inf if self.logspace else 0.0):
+            raise ZeroDivisionError('the evidence has probability 0')
+        values = np.exp(values - total) if self.logspace else values / total
+        keys = itertools.product(*[[self.value(v, i) for i in range(card[v])] for v in variables])
+        return dict(zip(keys, values.ravel().tolist()))
+
+    def maxproduct(self, variables, e):
+        """
+        Eliminate the hidden variables that are not in `variables` by summing
+        them out, then the variables by maximizing over them, and trace the
+        maximizing values back.
 
-        q = sys.argv[3]
-    except SyntaxError:
-        print('Invalid syntax for bayes net file %s' % sys.argv[1])
-    except IndexError:
-        print('Not enough argument.')
-        print('Usage: %s <bayesnet> <enum|elim> <query>' % sys.argv[0])
+        Args:
+            variables:  Set of variables to maximize over, not in e.
+            e:          Dictionary of evidence variables and observed values.
 
-    query(fname, alg, q)
+        Returns:
+            tuple (dictionary {variable: value} of the most likely values,
+            probability of these values and the evidence, or its logarithm if
+            `self.logspace`)
+        """
+        log = self.logspace
+        evidence = set(e)
+        hidden = set(self.net) - evidence - set(variables)
+
+        # sum out first, the order of the maximized variables does not change
+        # the result
+        graph = self.interactiongraph(evidence)
+        card = self.cardinalities()
+        order = triangulate(graph, 'minfill', keep=set(variables), card=card)[0]
+        order += triangulate(self.interactiongraph(evidence | hidden), 'minfill', card=card)[0]
+
+        factors, traceback = self.eliminate(order, e, maximize=variables)
+
+        # the factors left have no variables
+        values = [float(f.values) for f in factors]
+        prob = sum(values) if log else float(np.prod(values))
+
+        positions = {}
+        for var, argmax in reversed(traceback):
+            positions[var] = int(argmax.values[tuple(positions[v] for v in argmax.variables)])
+        return dict((v, self.value(v, positions[v])) for v in sorted(positions)), prob
+
+    def mpe(self, e):
+        """
+        Find the most probable explanation: the most likely values of all
+        the variables that are not in the evidence set, by max-product
+        elimination.
+
+        Args:
+            e:  Dictionary of evidence variables and observed values.
+
+        Returns:
+            tuple (dictionary {variable: value}, joint probability of the
+            values and the evidence, or its logarithm if `self.logspace`)
+        """
+        return self.maxproduct(set(self.net) - set(e), e)
+
+    def map(self, variables, e):
+        """
+        Find the maximum a posteriori values of some variables, the other
+        hidden variables being summed out. Variables that are neither
+        ancestors of the query variables nor of the evidence are left out.
+
+        Args:
+            variables:  Iterable of the query variables.
+            e:          Dictionary of evidence variables and observed values.
+
+        Returns:
+            tuple (dictionary {variable: value}, joint probability of the
+            values and the evidence, or its logarithm if `self.logspace`)
+        """
+        variables = set(variables)
+        if self.pruning:
+            net = self.subnet(self.ancestors(variables | set(e)))
+            return net.maxproduct(variables, e)
+        return self.maxproduct(variables, e)
+
+    def conditional(self, prob, e):
+        """
+        Turn the joint probability of values and the evidence, as given by
+        mpe and map, into the probability of the values given the evidence.
+
+        Args:
+            prob:   Joint probability, or its logarithm if `self.logspace`.
+            e:      Dictionary of evidence variables and observed values.
+
+        Returns:
+            P(values | e), not a logarithm in either case
+
+        Raises:
+            ValueError if the evidence has probability zero.
+        """
+        evidence = self.maxproduct(set(), e)[1]
+        if evidence == (-np.inf if self.logspace else 0):
+            raise ValueError('Evidence %s has probability zero' %
+                             ', '.join('%s=%s' % (v, self.statename(v, x)) for v, x in sorted(e.items())))
+        return float(np.exp(prob - evidence)) if self.logspace else prob / evidence
+
+    def plan_cost(self, X, e, heuristic=None):
+        """
+        Report the cost of eliminating for a query without running it.
+
+        Args:
+            X:          The query variable.
+            e:          Evidence variables, values are not used.
+            heuristic:  Ordering heuristic, see compile.
+
+        Returns:
+            Dictionary {
+                'heuristic': heuristic of the plan,
+                'order': list of the summed out variables,
+                'width': induced width of the order,
+                'maxfactor': number of entries of the largest factor,
+                'pruned': number of variables irrelevant to the query
+            }
+        """
+        plan = self.compile(X, e, heuristic)
+        return {
+            'heuristic': plan.heuristic,
+            'pruned': plan.pruned,
+            'order': [var for var, _, eliminate in plan.steps if eliminate is not None],
+            'width': plan.width,
+            'maxfactor': plan.maxsize
+        }
+
+    def batch_ask(self, X, evidence, variables=None):
+        """
+        Calculate the distributions over the query variable X for many rows of
+        evidence at once using elimination.
+
+        Args:
+            X:          The query variable.
+            evidence:   2-D array with one row of observations per query and
+                        one column per variable; 0 for False, 1 for True (the
+                        position of the state for other variables) and MISSING
+                        for variables that are not observed.
+            variables:  Names of the columns of `evidence`, all variables of
+                        the net in alphabetical order by default.
+
+        Returns:
+            numpy array of shape (N, number of states of X) where row i is the
+            distribution over X given the evidence of row i.
+        """
+        evidence = np.asarray(evidence, dtype=int)
+        variables = sorted(self.net.keys()) if variables is None else list(variables)
+
+        # each observation becomes a likelihood vector over the values of the
+        # variable that zeroes the values that were not observed
+        likelihoods = {}
+        for j, v in enumerate(variables):
+            column = evidence[:, j]
+            rows = np.flatnonzero(column != MISSING)
+            if len(rows) > 0:
+                likelihoods[v] = np.ones((len(evidence), len(self.net[v]['states'])))
+                likelihoods[v][rows] = 0.0
+                likelihoods[v][rows, column[rows]] = 1.0
+
+        return self.compile(X, [], prune=False).runbatch(self, likelihoods, len(evidence))
+
+    def sample(self, n, e, rng):
+        """
+        Draw samples of all the variables in topological order, the evidence
+        variables being set to their observed values.
+
+        Args:
+            n:      Number of samples.
+            e:      Dictionary of evidence variables and observed values.
+            rng:    numpy.random.Generator
+
+        Returns:
+            tuple (samples, weights) where
+                samples: dictionary {variable: integer array of n values}
+                weights: array of the likelihoods of the evidence in each sample
+        """
+        samples = {}
+        weights = np.ones(n)
+        for v in self.toposort():
+            # distributions over v given the values of its parents in each sample
+            dist = self.net[v]['cpt'][tuple(samples[p] for p in self.net[v]['parents'])]
+            if v in e:
+                x = self.index(v, e[v])
+                samples[v] = np.full(n, x)
+                weights = weights * dist[..., x]
+            else:
+                samples[v] = categorical(dist, rng, n)
+        return samples, weights
+
+    def prior_sample(self, n, seed=None):
+        """
+        Draw samples from the joint distribution of the network.
+
+        Args:
+            n:      Number of samples.
+            seed:   Seed of the random number generator.
+
+        Returns:
+            Dictionary {variable: integer array of n values}
+        """
+        return self.sample(n, {}, np.random.default_rng(seed))[0]
+
+    def estimate(self, draw, k, n, stderr, batch=1000):
+        """
+        Estimate the distribution over a query variable from weighted samples
+        drawn in batches.
+
+        Args:
+            draw:   Function of a number of samples returning a tuple (integer
+                    array of values of the query variable, array of weights).
+            k:      Number of values of the query variable.
+            n:      Maximum number of samples.
+            stderr: Stop as soon as the standard errors of the estimated
+                    probabilities are at most this value; None to draw all n
+                    samples.
+            batch:  Number of samples drawn at a time.
+
+        Returns:
+            Array of the sums of the weights of the samples with each value.
+        """
+        totals = np.zeros(k)
+        squares = 0.0   # sum of the squared weights
+        drawn = 0
+        while drawn < n:
+            values, weights = draw(min(batch, n - drawn))
+            drawn += len(values)
+            totals += np.bincount(values, weights=weights, minlength=k)
+            squares += np.dot(weights, weights)
+            if stderr is not None and totals.sum() > 0:
+                # effective sample size of the weighted samples
+                p = totals / totals.sum()
+                if np.sqrt(p * (1 - p) * squares).max() / totals.sum() <= stderr:
+                    break
+        return totals
+
+    def sampled(self, totals, unnormalized):
+        """
+        Distribution estimated from the weights of the samples.
+
+        Args:
+            totals:         Array of the sums of the weights for each value.
+            unnormalized:   Return the sums themselves, e.g. to merge them
+                            with those of other runs.
+
+        Returns:
+            Tuple of normalized values, or of the sums if unnormalized.
+        """
+        if unnormalized:
+            return tuple(totals.tolist())
+        if totals.sum() == 0:
+            raise ValueError('No sample is consistent with the evidence')
+        return self.normalize(totals.tolist())
+
+    def rejection_ask(self, X, e, n=10000, stderr=None, seed=None, totals=False):
+        """
+        Estimate the distribution over the query variable X by drawing samples
+        from the network and rejecting those that disagree with the evidence.
+
+        Args:
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            n:      Maximum number of samples.
+            stderr: Target standard error, see estimate.
+            seed:   Seed of the random number generator.
+            totals: Return the sums of the weights of the samples, see sampled.
+
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
+        """
+        if self.pruning:
+            net, e = self.prune(X, e)
+            return net.rejection_ask(X, e, n, stderr, seed, totals)
+
+        rng = np.random.default_rng(seed)
+        def draw(size):
+            samples, _ = self.sample(size, {}, rng)
+            accepted = np.ones(size)
+            for v, x in e.items():
+                accepted *= samples[v] == self.index(v, x)
+            return samples[X], accepted
+        return self.sampled(self.estimate(draw, len(self.net[X]['states']), n, stderr), totals)
+
+    def likelihood_ask(self, X, e, n=10000, stderr=None, seed=None, totals=False):
+        """
+        Estimate the distribution over the query variable X by likelihood
+        weighting: the evidence variables are fixed and each sample is weighted
+        by the likelihood of the evidence.
+
+        Args:
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            n:      Maximum number of samples.
+            stderr: Target standard error, see estimate.
+            seed:   Seed of the random number generator.
+            totals: Return the sums of the weights of the samples, see sampled.
+
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
+        """
+        if self.pruning:
+            net, e = self.prune(X, e)
+            return net.likelihood_ask(X, e, n, stderr, seed, totals)
+
+        rng = np.random.default_rng(seed)
+        def draw(size):
+            samples, weights = self.sample(size, e, rng)
+            return samples[X], weights
+        return self.sampled(self.estimate(draw, len(self.net[X]['states']), n, stderr), totals)
+
+    def gibbs_ask(self, X, e, n=10000, stderr=None, seed=None, totals=False, chains=100, burnin=100):
+        """
+        Estimate the distribution over the query variable X by Gibbs sampling:
+        chains run side by side, each step resampling every non-evidence
+        variable given its Markov blanket.
+
+        Args:
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            n:      Maximum number of samples, summed over the chains.
+            stderr: Target standard error, see estimate; successive samples
+                    of a chain are correlated so it is an underestimate.
+            seed:   Seed of the random number generator.
+            totals: Return the sums of the weights of the samples, see sampled.
+            chains: Number of chains.
+            burnin: Number of steps discarded at the start of the chains.
+
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e)), or over
+            the states of X in order
+        """
+        if self.pruning:
+            net, e = self.prune(X, e)
+            return net.gibbs_ask(X, e, n, stderr, seed, totals, chains, burnin)
+
+        rng = np.random.default_rng(seed)
+        # start from samples consistent with the evidence, chains whose sample
+        # has weight 0 being redrawn from the others by weight
+        state, weights = self.sample(chains, e, rng)
+        if weights.sum() == 0:
+            raise ValueError('No sample is consistent with the evidence')
+        starts = rng.choice(chains, chains, p=weights / weights.sum())
+        state = dict((v, values[starts]) for v, values in state.items())
+        hidden = [v for v in self.toposort() if v not in e]
+
+        def step():
+            for v in hidden:
+                # P(v | parents) * product of P(c | parents of c) for the
+                # children c, for every value of v
+                dist = self.net[v]['cpt'][tuple(state[p] for p in self.net[v]['parents'])]
+                dist = np.broadcast_to(dist, (chains, len(self.net[v]['states']))).copy()
+                for c in self.net[v]['children']:
+                    cpt = self.net[c]['cpt']
+                    for x in range(dist.shape[1]):
+                        index = tuple(np.full(chains, x) if p == v else state[p]
+                                      for p in self.net[c]['parents'])
+                        dist[:, x] *= cpt[index + (state[c],)]
+                state[v] = categorical(dist, rng, chains)
+
+        for _ in range(burnin):
+            step()
+
+        def draw(size):
+            values = []
+            for _ in range(-(-size // chains)):
+                step()
+                values.append(state[X].copy())
+            values = np.concatenate(values)
+            return values, np.ones(len(values))
+        return self.sampled(self.estimate(draw, len(self.net[X]['states']), n, stderr,
+                                          batch=max(1000, chains)), totals)
+
+    def junctiontree(self):
+        """
+        Build a junction tree of the network to get the distributions over all
+        the variables given the same evidence set in one calibration.
+
+        Returns:
+            JunctionTree
+        """
+        tree = JunctionTree(self)
+        self.trees.add(tree)
+        return tree
+
+class Factor:
+    """
+    Factor backed by an n-dimensional numpy array.
+
+    Data structure(s):
+        variables -> list of variables in alphabetical order
+        values -> numpy array with one axis per variable, in the same order;
+            index 0 along an axis is False, 1 is True; positions of the
+            states for variables that are not boolean
+
+        log -> whether the values are the logarithms of the entries
+
+        e.g. the factor for 'D' in ex2.bn given B=t
+            variables: ['A', 'D']
+            values: array([[0.9, 0.1],
+                           [0.3, 0.7]])
+    """
+    def __init__(self, variables, values, log=False):
+        self.variables = list(variables)
+        self.values = values
+        self.log = log
+
+    def __repr__(self):
+        if self.log:
+            return 'Factor(%r, %r, log=True)' % (self.variables, self.values)
+        return 'Factor(%r, %r)' % (self.variables, self.values)
+
+    @classmethod
+    def fromdict(cls, variables, entries):
+        """
+        Make a factor from a mapping {tuple of values: probability}, where
+        values are True/False or positions of states.
+
+        Args:
+            variables:  List of variables in alphabetical order.
+            entries:    Dictionary of every assignment of the variables.
+
+        Returns:
+            Factor
+        """
+        if len(variables) == 0:
+            return cls([], np.array(entries[()]))
+        # flat position of each assignment by the strides of the array
+        keys = np.array(list(entries.keys()), dtype=np.intp).reshape(len(entries), len(variables))
+        shape = tuple(int(k) + 1 for k in keys.max(axis=0))
+        values = np.zeros(int(np.prod(shape)))
+        values[np.ravel_multi_index(keys.T, shape)] = list(entries.values())
+        return cls(variables, values.reshape(shape))
+
+    def todict(self):
+        """
+        Mapping {tuple of values: probability} of the entries of the factor,
+        with True/False for the variables with two values.
+        """
+        values = [(False, True) if n == 2 else range(n) for n in self.values.shape]
+        return dict(zip(itertools.product(*values), self.values.ravel().tolist()))
+
+    def align(self, variables):
+        """
+        Expand the values so that they broadcast over the given variables.
+
+        Args:
+            variables:  Sorted list of variables, a superset of self.variables.
+
+        Returns:
+            View of the values with one axis per variable in `variables`, the
+            axes of variables not in this factor having length 1.
+        """
+        shape = [1] * len(variables)
+        for v, n in zip(self.variables, self.values.shape):
+            shape[variables.index(v)] = n
+        return self.values.reshape(shape)
+
+    def pointwise(self, other):
+        """
+        Pointwise-product of this factor and another factor.
+
+        Args:
+            other:  Factor
+
+        Returns:
+            New factor over the union of the variables of both factors.
+        """
+        assert(self.log == other.log)
+        variables = sorted(set(self.variables) | set(other.variables))
+        if self.log:
+            return Factor(variables, self.align(variables) + other.align(variables), True)
+        return Factor(variables, self.align(variables) * other.align(variables))
+
+    def sumout(self, var):
+        """
+        Sum var out of the factor.
+
+        Args:
+            var:    A variable of the factor.
+
+        Returns:
+            New factor without var.
+        """
+        axis = self.variables.index(var)
+        values = logsumexp(self.values, axis) if self.log else self.values.sum(axis=axis)
+        return Factor(self.variables[:axis] + self.variables[axis+1:], values, self.log)
+
+    def maxout(self, var):
+        """
+        Maximize var out of the factor.
+
+        Args:
+            var:    A variable of the factor.
+
+        Returns:
+            tuple (new factor without var, factor of the positions of the
+            values of var reaching the maximum)
+        """
+        axis = self.variables.index(var)
+        variables = self.variables[:axis] + self.variables[axis+1:]
+        return (Factor(variables, self.values.max(axis=axis), self.log),
+                Factor(variables, self.values.argmax(axis=axis)))
+
+    def entries(self):
+        """
+        Iterate over the entries of the factor, False before True.
+
+        Returns:
+            Generator of (tuple of positions of the values of the variables,
+            i.e. 0 for False and 1 for True, probability)
+        """
+        values = np.exp(self.values) if self.log else self.values
+        for index in np.ndindex(*values.shape):
+            yield index, float(values[index])
+
+class ResultCache:
+    """
+    Cache of the answers of queries, in front of Net.enum_ask and
+    Net.elim_ask once set as `Net.results`. Answers are keyed on the
+    fingerprint of the network, the algorithm, the query variable and the
+    evidence, see Net.resultkey, so the cache can be shared by networks and
+    answers of a network that changed are not reused. The least recently used
+    answers are dropped once there are more than `maxsize`, and answers older
+    than `ttl` seconds are computed again.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        """
+        Args:
+            maxsize:    Number of answers kept.
+            ttl:        Seconds an answer is kept, forever by default.
+            clock:      Function returning the time in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()    # key -> (expiry time, answer)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def ask(self, key, compute):
+        """
+        Get the answer of a query, computing it if it is not in the cache.
+
+        Args:
+            key:        Key of the query.
+            compute:    Function computing the answer.
+
+        Returns:
+            The answer
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or now < entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        answer = compute()
+        with self.lock:
+            self.entries[key] = (None if self.ttl is None else now + self.ttl, answer)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return answer
+
+    def clear(self):
+        """
+        Drop all the answers.
+        """
+        with self.lock:
+            self.entries.clear()
+
+def logsumexp(values, axis=None):
+    """
+    Logarithm of the sum of the exponentials of the values, computed without
+    underflow by factoring out the largest value.
+
+    Args:
+        values: numpy array of logarithms.
+        axis:   Axis to sum over, all of them by default.
+
+    Returns:
+        numpy array without the axis, or a number
+    """
+    top = np.max(values, axis=axis, keepdims=True)
+    top = np.where(np.isfinite(top), top, 0.0)
+    with np.errstate(divide='ignore'):
+        total = np.log(np.sum(np.exp(values - top), axis=axis))
+    return total + (top.reshape(()) if axis is None else np.squeeze(top, axis))
+
+def categorical(dist, rng, n):
+    """
+    Draw values from discrete distributions.
+
+    Args:
+        dist:   Array of (unnormalized) distributions over its last axis, of
+                shape (k,) or (n, k).
+        rng:    numpy.random.Generator
+        n:      Number of values.
+
+    Returns:
+        Integer array of n positions along the last axis of dist.
+    """
+    cumulative = np.cumsum(dist, axis=-1)
+    u = rng.random(n) * cumulative[..., -1]
+    return np.minimum((cumulative <= u[:, np.newaxis]).sum(axis=-1), dist.shape[-1] - 1)
+
+def _fillin(graph, v, card):
+    """
+    Fill-in edges needed to eliminate v from the graph, weighted by the
+    product of the number of values of their endpoints.
+    """
+    return sum(card(a) * card(b) for a, b in itertools.combinations(sorted(graph[v]), 2)
+               if b not in graph[a])
+
+# Heuristics ordering the elimination of variables on an interaction graph;
+# each maps (graph, variable, number of values of a variable) to a cost.
+HEURISTICS = {
+    'mindegree': lambda graph, v, card: len(graph[v]),
+    'minweight': lambda graph, v, card: np.prod([card(u) for u in graph[v] | {v}]),
+    'minfill': lambda graph, v, card: _fillin(graph, v, lambda u: 1),
+    'weightedminfill': _fillin,
+}
+
+def triangulate(graph, heuristic='minfill', keep=(), card=None):
+    """
+    Eliminate the variables of an undirected graph greedily by the cost given
+    by the heuristic, ties broken by degree and then alphabetically.
+
+    Args:
+        graph:      Dictionary {variable: set of neighbors}; not modified.
+        heuristic:  Name of one of HEURISTICS.
+        keep:       Variables that are not eliminated.
+        card:       Dictionary {variable: number of values}, 2 by default.
+
+    Returns:
+        tuple (order, cliques) where
+            order: list of eliminated variables
+            cliques: list of sets, each eliminated variable with its neighbors
+                at elimination time
+    """
+    cost = HEURISTICS[heuristic]
+    size = (lambda v: 2) if card is None else card.__getitem__
+    graph = dict((v, set(ns)) for v, ns in graph.items())
+    order, cliques = [], []
+    left = set(graph) - set(keep)
+    while len(left) > 0:
+        var = min(left, key=lambda v: (cost(graph, v, size), len(graph[v]), v))
+        for a, b in itertools.combinations(graph[var], 2):
+            graph[a].add(b)
+            graph[b].add(a)
+        cliques.append(graph[var] | {var})
+        for v in graph.pop(var):
+            graph[v].discard(var)
+        left.remove(var)
+        order.append(var)
+    return order, cliques
+
+class QueryPlan:
+    """
+    Variable elimination compiled for one query variable and one set of
+    evidence variables, so that queries differing only in the observed values
+    skip the ordering.
+
+    Data structure(s):
+        X -> the query variable
+        evidence -> frozenset of the evidence variables
+        steps -> list of (var, make, eliminate) in elimination order where
+            make -> None if var has no factor, else (evars, axes, variables)
+                evars: evidence variables among var and its parents
+                axes: transposition of the CPT putting the axes of evars first
+                    and then the axes of the factor variables
+                variables: variables of the factor, in alphabetical order;
+                    empty when var and its parents are all observed
+            eliminate -> None if var is not hidden, else (take, shapes, axis, variables)
+                take: positions of the factors to multiply in the factor list
+                shapes: shapes broadcasting each of these factors over the product
+                axis: axis of var in the product
+                variables: variables of the factor left after summing out var
+        Factors without variables are constants, which only matter to the
+        unnormalized results, see run; they are kept apart from the factor
+        list.
+    """
+    def __init__(self, net, X, evidence, heuristic='greedy'):
+        """
+        Determine the elimination order and the factor layouts.
+
+        Args:
+            net:        Net
+            X:          The query variable.
+            evidence:   frozenset of the evidence variables.
+            heuristic:  'greedy' to pick the next variable among those whose
+                        children have been eliminated by the size of its CPT
+                        factor, or one of HEURISTICS to order the variables on
+                        the interaction graph.
+        """
+        self.X = X
+        self.evidence = evidence
+        self.heuristic = heuristic
+        self.steps = []
+        self.width = 0      # induced width, variables in the largest product - 1
+        self.maxsize = 1    # number of entries of the largest factor
+        self.largest = []   # variables of the largest factor
+        self.pruned = 0     # number of variables irrelevant to the query
+
+        if heuristic == 'greedy':
+            sequence = self.greedyorder(net)
+        else:
+            order, _ = triangulate(net.interactiongraph(evidence), heuristic, keep={X},
+                                   card=net.cardinalities())
+            sequence = [(v, True, False) for v in sorted(net.net.keys())]
+            sequence.extend((v, False, True) for v in order)
+
+        card = net.cardinalities()
+        scopes = []     # variables of the factors at each step
+        for var, make, eliminate in sequence:
+            # make the factor of the CPT of var
+            if make:
+                allvars = net.net[var]['parents'] + [var]
+                evars = [v for v in allvars if v in evidence]
+                scope = sorted(v for v in allvars if v not in evidence)
+                axes = [allvars.index(v) for v in evars + scope]
+                make = (evars, axes, scope)
+                if len(scope) > 0:
+                    scopes.append(scope)
+                    self.grow(scope, card)
+            else:
+                make = None
+
+            # sum var out of the product of the factors that contain it
+            if eliminate:
+                take = [i for i, s in enumerate(scopes) if var in s]
+                product = sorted(set().union(*(scopes[i] for i in take)))
+                shapes = [tuple(card[v] if v in scopes[i] else 1 for v in product) for i in take]
+                axis = product.index(var)
+                scope = product[:axis] + product[axis+1:]
+                scopes = [s for i, s in enumerate(scopes) if i not in take]
+                if len(scope) > 0:
+                    scopes.append(scope)
+                eliminate = (take, shapes, axis, scope)
+                self.width = max(self.width, len(product) - 1)
+                self.grow(product, card)
+            else:
+                eliminate = None
+
+            self.steps.append((var, make, eliminate))
+
+    def grow(self, variables, card):
+        """
+        Account for a factor over the given variables in maxsize and largest.
+        """
+        size = int(np.prod([card[v] for v in variables]))
+        if size > self.maxsize:
+            self.maxsize = size
+            self.largest = variables
+
+    def greedyorder(self, net):
+        """
+        Order the variables, each time picking among the variables whose
+        children have been eliminated the one with the smallest CPT factor.
+
+        Args:
+            net:    Net
+
+        Returns:
+            List of (var, make, eliminate) where make tells whether var has a
+            factor, always, and eliminate whether var is summed out.
+        """
+        X, evidence = self.X, self.evidence
+        graph = net.graph
+
+        # number of variables in the factor of each variable, not counting
+        # the ones in the evidence set: the variable itself and its parents
+        size = [sum(1 for p in graph.parents[i] if graph.names[p] not in evidence)
+                + (graph.names[i] not in evidence) for i in range(len(graph.names))]
+
+        # the variables whose children have all been eliminated are candidates,
+        # taken by the size of the factor and then alphabetically
+        remaining = [len(cs) for cs in graph.children]
+        heap = [(size[i], i) for i in range(len(remaining)) if remaining[i] == 0]
+        heapq.heapify(heap)
+        sequence = []
+        while len(heap) > 0:
+            _, i = heapq.heappop(heap)
+            var = graph.names[i]
+            sequence.append((var, True, var != X and var not in evidence))
+            for p in graph.parents[i]:
+                remaining[p] -= 1
+                if remaining[p] == 0:
+                    heapq.heappush(heap, (size[p], p))
+        return sequence
+
+    def run(self, net, e, stats=None, normalize=True):
+        """
+        Calculate the distribution over the query variable.
+
+        Args:
+            net:        Net the plan was compiled for.
+            e:          Dictionary of evidence variables and observed values.
+            stats:      Optional QueryStats filled with the time of each phase
+                        and the sizes of the factors.
+            normalize:  False to get the numpy array of the joint
+                        probabilities of X and e instead, or of their
+                        logarithms in log space; the factors without
+                        variables, constants dropped by normalizing, are then
+                        multiplied in.
+
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e))
+        """
+        if net.trace is not None and self.pruned > 0:
+            net.trace('Pruned %d of %d variables', self.pruned, len(net.net))
+
+        # in log space products are sums and sums are log-sum-exps
+        log = net.logspace
+        multiply = np.add if log else np.multiply
+
+        factors = []
+        constants = []
+        for var, make, eliminate in self.steps:
+            if net.trace is not None:
+                net.trace('----- Variable: %s -----', var)
+
+            if make is not None and (len(make[2]) > 0 or not normalize):
+                if stats is not None:
+                    start = time.perf_counter()
+                evars, axes, scope = make
+                cpt = net.logcpt(var) if log else net.net[var]['cpt']
+                values = cpt.transpose(axes)[tuple(net.index(v, e[v]) for v in evars)]
+                if len(scope) > 0:
+                    factors.append(Factor(scope, values, log))
+                else:
+                    constants.append(values)
+                if stats is not None:
+                    stats.record('makefactor', start)
+                    stats.track(factors, values)
+
+            if eliminate is not None:
+                if stats is not None:
+                    start = time.perf_counter()
+                take, shapes, axis, scope = eliminate
+                product = factors[take[0]].values.reshape(shapes[0])
+                for i, shape in zip(take[1:], shapes[1:]):
+                    product = multiply(product, factors[i].values.reshape(shape))
+                if stats is not None:
+                    start = stats.record('pointwise', start)
+                    stats.track(factors, product)
+                factors = [f for i, f in enumerate(factors) if i not in take]
+                if len(scope) > 0:
+                    factors.append(Factor(scope, logsumexp(product, axis) if log else product.sum(axis=axis), log))
+                elif not normalize:
+                    constants.append(logsumexp(product, axis) if log else product.sum(axis=axis))
+                if stats is not None:
+                    stats.record('sumout', start)
+                    stats.track(factors, factors[-1].values if len(scope) > 0 else None)
+
+            if net.trace is not None:
+                net.tracefactors(factors)
+
+        # calculate the pointwise-product then normalize
+        if stats is not None:
+            start = time.perf_counter()
+        result = factors[0].values
+        for factor in factors[1:]:
+            result = multiply(result, factor.values)
+        if stats is not None:
+            start = stats.record('pointwise', start)
+        if not normalize:
+            for constant in constants:
+                result = multiply(result, constant)
+            return result
+        dist = net.lognormalize(result.tolist()) if log else net.normalize(result.tolist())
+        if stats is not None:
+            stats.record('normalize', start)
+        return dist
+
+    def runbatch(self, net, likelihoods, n):
+        """
+        Calculate the distributions over the query variable for a batch of
+        evidence rows, in log space if `net.logspace`. The plan must be
+        compiled without evidence variables; the factors carry a leading axis
+        over the rows.
+
+        Args:
+            net:            Net the plan was compiled for.
+            likelihoods:    Dictionary {variable: array of shape (n, number of
+                            states)} of evidence likelihoods, see Net.batch_ask.
+            n:              Number of rows.
+
+        Returns:
+            numpy array of shape (n, number of states of X) of normalized
+            distributions.
+
+        Raises:
+            ZeroDivisionError if the evidence of a row has probability 0.
+        """
+        assert(len(self.evidence) == 0)
+        log = net.logspace
+        multiply = np.add if log else np.multiply
+        factors = []
+        for var, make, eliminate in self.steps:
+            if make is not None:
+                evars, axes, scope = make
+                cpt = net.logcpt(var) if log else net.net[var]['cpt']
+                values = cpt.transpose(axes)[np.newaxis]
+                if var in likelihoods:
+                    shape = [n] + [-1 if v == var else 1 for v in scope]
+                    likelihood = likelihoods[var].reshape(shape)
+                    if log:
+                        with np.errstate(divide='ignore'):
+                            likelihood = np.log(likelihood)
+                    values = multiply(values, likelihood)
+                factors.append(Factor(scope, values, log))
+
+            if eliminate is not None:
+                take, shapes, axis, scope = eliminate
+                product = factors[take[0]].values
+                product = product.reshape(product.shape[:1] + shapes[0])
+                for i, shape in zip(take[1:], shapes[1:]):
+                    values = factors[i].values
+                    product = multiply(product, values.reshape(values.shape[:1] + shape))
+                factors = [f for i, f in enumerate(factors) if i not in take]
+                if len(scope) > 0:
+                    factors.append(Factor(scope, logsumexp(product, axis+1) if log else product.sum(axis=axis+1), log))
+
+        result = np.full((n, len(net.net[self.X]['states'])), 0.0 if log else 1.0)
+        for factor in factors:
+            result = multiply(result, factor.values)
+        total = logsumexp(result, 1) if log else result.sum(axis=1)
+        impossible = np.flatnonzero(total == (-np.inf if log else 0))
+        if len(impossible) > 0:
+            raise ZeroDivisionError('the evidence of row %d has probability 0' % impossible[0])
+        if log:
+            return np.exp(result - total[:, np.newaxis])
+        return result / total[:, np.newaxis]
+
+class QueryStats:
+    """
+    Measurements of an elim_ask query, see Net.profile.
+
+    Data structure(s):
+        X -> the query variable
+        evidence -> dictionary of the evidence set
+        plan -> the QueryPlan that was run
+        times -> dictionary {phase: seconds} over the phases 'ordering'
+            (getting the plan), 'makefactor', 'pointwise', 'sumout' and
+            'normalize'
+        factorsizes -> list of the numbers of entries of the factors made
+            and of the products, in order
+        peakbytes -> largest total size of the factors alive at once, in
+            bytes
+    """
+    PHASES = ['ordering', 'makefactor', 'pointwise', 'sumout', 'normalize']
+
+    def __init__(self, X, evidence):
+        self.X = X
+        self.evidence = dict(evidence)
+        self.plan = None
+        self.times = dict((phase, 0.0) for phase in self.PHASES)
+        self.factorsizes = []
+        self.peakbytes = 0
+
+    def __repr__(self):
+        return 'QueryStats(%s, %s, peakbytes=%d, largest=%d)' % (
+                self.X, ' '.join('%s=%.6f' % (p, self.times[p]) for p in self.PHASES),
+                self.peakbytes, max(self.factorsizes, default=0))
+
+    def record(self, phase, start):
+        """
+        Add the time since start to a phase.
+
+        Returns:
+            The current time, the start of the next phase
+        """
+        now = time.perf_counter()
+        self.times[phase] += now - start
+        return now
+
+    def track(self, factors, new=None):
+        """
+        Account for the factors alive and for new values, of a factor just
+        made or of a product being computed.
+        """
+        total = sum(f.values.nbytes for f in factors)
+        if new is not None:
+            self.factorsizes.append(new.size)
+            if not any(f.values is new for f in factors):
+                total += new.nbytes
+        self.peakbytes = max(self.peakbytes, total)
+
+class JunctionTree:
+    """
+    Junction (clique) tree of a Bayesian network. The tree is calibrated by
+    passing messages between neighboring cliques (Shafer-Shenoy), after which
+    the distribution over every variable can be read from any clique that
+    contains it.
+
+    Data structure(s):
+        cliques -> list of cliques, each a sorted list of variables
+        neighbors -> list of lists of the indices of adjacent cliques
+        potentials -> list of Factor, the product of the CPTs assigned to
+            each clique
+        home -> dictionary {variable: index of the clique its CPT is
+            assigned to}
+        assigned -> list of the lists of the variables whose CPTs are
+            assigned to each clique
+        net -> the Net
+        evidence -> dictionary of the current evidence set, values given by
+            their positions in the states of the variables
+        messages -> dictionary {(i, j): Factor} of the messages from clique i
+            to clique j that are valid for the current evidence
+        schedule -> list of (i, j) such that every message is preceded by the
+            messages it depends on
+    """
+    def __init__(self, net):
+        """
+        Moralize and triangulate the network, form the cliques and connect them
+        with a maximum spanning tree over the sizes of the separators.
+
+        Args:
+            net:    Net
+        """
+        self.net = net
+
+        # 1. moral graph: connect each variable with its parents and marry the
+        # parents of each variable
+        # 2. triangulation: eliminate the variables by the number of fill-in
+        # edges, each variable and its neighbors at elimination time form a
+        # clique; keep the maximal ones
+        cliques = []
+        for clique in triangulate(net.interactiongraph(()), 'minfill', card=net.cardinalities())[1]:
+            if not any(clique <= c for c in cliques):
+                cliques.append(clique)
+        self.cliques = [sorted(c) for c in cliques]
+
+        # 3. maximum spanning tree, Kruskal's; cliques of disconnected parts of
+        # the network are joined by empty separators
+        edges = sorted(itertools.combinations(range(len(cliques)), 2),
+                       key=lambda ij: -len(cliques[ij[0]] & cliques[ij[1]]))
+        component = list(range(len(cliques)))
+        def find(i):
+            while component[i] != i:
+                i = component[i]
+            return i
+        self.neighbors = [[] for _ in cliques]
+        for i, j in edges:
+            if find(i) != find(j):
+                component[find(i)] = find(j)
+                self.neighbors[i].append(j)
+                self.neighbors[j].append(i)
+
+        # 4. assign each CPT to a clique containing the variable and its parents
+        self.home = {}
+        self.assigned = [[] for _ in cliques]
+        for v in net.net:
+            family = set(net.net[v]['parents'] + [v])
+            self.home[v] = next(i for i, c in enumerate(cliques) if family <= c)
+            self.assigned[self.home[v]].append(v)
+        self.potentials = [self.potential(i) for i in range(len(cliques))]
+
+        # message schedule: towards clique 0 then away from it
+        up, down = [], []
+        stack, visited = [(0, None)], {0}
+        while len(stack) > 0:
+            i, parent = stack.pop()
+            if parent is not None:
+                up.append((i, parent))
+                down.append((parent, i))
+            for j in self.neighbors[i]:
+                if j not in visited:
+                    visited.add(j)
+                    stack.append((j, i))
+        self.schedule = list(reversed(up)) + down
+
+        self.evidence = {}
+        self.messages = {}
+
+    def potential(self, i):
+        """
+        Product of the CPTs assigned to clique i.
+
+        Args:
+            i:  Index of the clique.
+
+        Returns:
+            Factor over the clique.
+        """
+        clique = self.cliques[i]
+        potential = Factor(clique, np.ones([len(self.net.net[v]['states']) for v in clique]))
+        for v in self.assigned[i]:
+            potential = potential.pointwise(self.net.cptfactor(v, {}))
+        return potential
+
+    def update(self, var):
+        """
+        Take into account a change of the CPT of var: the potential of its
+        clique is computed again and the messages directed away from it are
+        invalidated.
+
+        Args:
+            var:    The variable whose CPT changed.
+        """
+        i = self.home[var]
+        self.potentials[i] = self.potential(i)
+        self.invalidate(i)
+
+    def setevidence(self, e):
+        """
+        Replace the evidence set. Only the messages that depend on evidence
+        variables whose values changed are invalidated.
+
+        Args:
+            e:  Dictionary of evidence variables and observed values.
+        """
+        e = dict((v, self.net.index(v, x)) for v, x in e.items())
+        changed = set(e.items()) ^ set(self.evidence.items())
+        for v, _ in changed:
+            self.invalidate(self.home[v])
+        self.evidence = e
+
+    def invalidate(self, i):
+        """
+        Drop the messages directed away from clique i.
+
+        Args:
+            i:  Index of the clique whose potential changed.
+        """
+        stack = [(i, None)]
+        while len(stack) > 0:
+            i, parent = stack.pop()
+            for j in self.neighbors[i]:
+                if j != parent:
+                    self.messages.pop((i, j), None)
+                    stack.append((j, i))
+
+    def belief(self, i, exclude=None):
+        """
+        Product of the potential of clique i, the evidence in it and the
+        messages it received.
+
+        Args:
+            i:          Index of the clique.
+            exclude:    Index of a neighbor whose message is left out.
+
+        Returns:
+            Factor over the clique.
+        """
+        values = self.potentials[i].values
+        clique = self.cliques[i]
+        for v, x in self.evidence.items():
+            if self.home[v] == i:
+                likelihood = np.zeros(self.potentials[i].values.shape[clique.index(v)])
+                likelihood[x] = 1.0
+                values = values * Factor([v], likelihood).align(clique)
+        for j in self.neighbors[i]:
+            if j != exclude:
+                values = values * self.messages[(j, i)].align(clique)
+        return Factor(clique, values)
+
+    def calibrate(self):
+        """
+        Compute the messages that are missing for the current evidence.
+        """
+        for i, j in self.schedule:
+            if (i, j) not in self.messages:
+                belief = self.belief(i, exclude=j)
+                separator = set(self.cliques[j])
+                axes = tuple(k for k, v in enumerate(belief.variables) if v not in separator)
+                self.messages[(i, j)] = Factor([v for v in belief.variables if v in separator],
+                                               belief.values.sum(axis=axes))
+
+    def marginals(self):
+        """
+        Calculate the distributions over all the variables.
+
+        Returns:
+            Dictionary {variable: (P(X=f | e), P(X=t | e))}, or tuples over
+            the states of the variables that are not boolean
+        """
+        self.calibrate()
+        dists = {}
+        for i, clique in enumerate(self.cliques):
+            belief = None
+            for k, v in enumerate(clique):
+                if v not in dists and self.home[v] == i:
+                    if belief is None:
+                        belief = self.belief(i).values
+                    axes = tuple(a for a in range(len(clique)) if a != k)
+                    dist = belief.sum(axis=axes)
+                    total = dist.sum()
+                    if total == 0:
+                        raise ZeroDivisionError('the evidence has probability 0')
+                    dists[v] = tuple((dist / total).tolist())
+        return dists
+
+# network of a worker process of a NetPool
+_workernet = None
+# attributes of a Net that change the answers of its queries, copied to the
+# networks of the worker processes
+WORKERSETTINGS = ['pruning', 'heuristic', 'logspace', 'maxfactor', 'maxconditions']
+
+def _initworker(text, settings):
+    """
+    Build the network of a worker process from its text form, once, with the
+    settings of the network it copies, see WORKERSETTINGS.
+    """
+    global _workernet
+    _workernet = Net(None)
+    _workernet.read(text.splitlines(True))
+    for name, value in settings.items():
+        setattr(_workernet, name, value)
+
+def _workerask(method, args, kwargs):
+    """
+    Run a query on the network of a worker process.
+    """
+    return getattr(_workernet, method)(*args, **kwargs)
+
+def _workerlines(alg, lines, n, seed):
+    """
+    Answer numbered query lines on the network of a worker process.
+    """
+    return [answerline(_workernet, alg, q, n, seed, lineno) for lineno, q in lines]
+
+class NetPool:
+    """
+    Pool of worker processes answering queries on copies of a network. The
+    network is sent to each worker once, in the text form of Net.dumps with
+    the settings of WORKERSETTINGS, when the worker starts.
+
+    >>> with NetPool(Net('alarm.bn'), workers=4) as pool:
+    ...     dists = pool.ask([('B', {'J': True}), ('E', {'M': False})])
+    """
+    def __init__(self, net, workers=None):
+        """
+        Start the worker processes.
+
+        Args:
+            net:        Net
+            workers:    Number of processes, the number of CPUs by default.
+        """
+        self.workers = os.cpu_count() if workers is None else workers
+        settings = dict((name, getattr(net, name)) for name in WORKERSETTINGS)
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers,
+                initializer=_initworker, initargs=(net.dumps(), settings))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self.executor.shutdown()
+
+    def ask(self, queries, alg='elim', chunksize=16, **kwargs):
+        """
+        Answer independent queries in the worker processes.
+
+        Args:
+            queries:    Iterable of (X, e) pairs.
+            alg:        'enum', 'elim' or one of SAMPLERS.
+            chunksize:  Number of queries sent to a worker at a time.
+            kwargs:     Extra arguments of the algorithm, e.g. n for samplers.
+
+        Returns:
+            Iterator over the distributions, in the order of the queries.
+        """
+        method = SAMPLERS.get(alg, alg + '_ask')
+        return self.executor.map(_workerask, itertools.repeat(method), queries,
+                                 itertools.repeat(kwargs), chunksize=chunksize)
+
+    def stream(self, lines, alg='elim', chunksize=64, n=10000, seed=None):
+        """
+        Answer query lines in the worker processes, reading them as they are
+        needed: at most two chunks per worker are in flight at a time.
+
+        Args:
+            lines:      Iterable of (line number, query), see answerline.
+            alg:        Algorithm, see answerline.
+            chunksize:  Number of queries sent to a worker at a time.
+            n, seed:    Number of samples and seed of the samplers.
+
+        Returns:
+            Iterator over the records of answerline, in the order of the lines.
+        """
+        lines = iter(lines)
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * self.workers:
+                chunk = list(itertools.islice(lines, chunksize))
+                if len(chunk) == 0:
+                    break
+                pending.append(self.executor.submit(_workerlines, alg, chunk, n, seed))
+            if len(pending) == 0:
+                return
+            for record in pending.popleft().result():
+                yield record
+
+    def sample_ask(self, alg, X, e, n=10000, stderr=None, seed=None, shards=None, **kwargs):
+        """
+        Estimate a distribution with the samples drawn in all the workers.
+
+        Args:
+            alg:    One of SAMPLERS.
+            X:      The query variable.
+            e:      Dictionary of evidence variables and observed values.
+            n:      Maximum number of samples, split evenly among the shards.
+            stderr: Target standard error of the merged estimate.
+            seed:   Seed from which independent seeds of the shards are derived.
+            shards: Number of tasks, the number of workers by default.
+            kwargs: Extra arguments of the sampler, e.g. chains for gibbs.
+
+        Returns:
+            Distribution over X as a tuple (P(X=f | e), P(X=t | e))
+        """
+        shards = self.workers if shards is None else shards
+        seeds = np.random.SeedSequence(seed).spawn(shards)
+        # the standard error of the merged estimate shrinks with the square
+        # root of the number of shards
+        stderr = None if stderr is None else stderr * np.sqrt(shards)
+        futures = [self.executor.submit(_workerask, SAMPLERS[alg], (X, e),
+                        dict(kwargs, n=-(-n // shards), stderr=stderr, seed=s, totals=True))
+                   for s in seeds]
+        totals = sum(np.array(f.result()) for f in futures)
+        if totals.sum() == 0:
+            raise ValueError('No sample is consistent with the evidence')
+        return tuple((totals / totals.sum()).tolist())
+
+def printtrace(msg, *args):
+    """
+    Trace callback that prints the steps of the inference algorithms.
+
+    Args:
+        msg:    Format string.
+        args:   Values for the format string.
+    """
+    print(msg % args if args else msg)
+
+# sampling algorithms and the methods implementing them
+SAMPLERS = {
+    'rejection': 'rejection_ask',
+    'likelihood': 'likelihood_ask',
+    'gibbs': 'gibbs_ask'
+}
+
+def parsequery(q):
+    """
+    Parse a query of the form P(X|A=t,B=f) or P(X).
+
+    Args:
+        q:  Query
+
+    Returns:
+        tuple (X, list of (variable, value) pairs of the evidence), values are
+        names of states, t and f for boolean variables
+    """
+    match = re.match(r'P\((.*)\|(.*)\)', q)
+    if match:
+        X = match.group(1).strip()
+        e = [tuple(x.strip() for x in v.split('=')) for v in match.group(2).split(',')]
+    else:
+        match = re.match(r'P\((.*)\)', q)
+        if match is None:
+            raise ValueError('Invalid query %s' % q)
+        X = match.group(1).strip()
+        e = []
+    if any(len(v) != 2 for v in e):
+        raise ValueError('Invalid evidence in query %s' % q)
+    return X, e
+
+def answer(net, alg, X, e, n=10000, seed=None):
+    """
+    Answer a query with the given algorithm.
+
+    Args:
+        net:    Net
+        alg:    Algorithm to use (enum, elim or one of SAMPLERS)
+        X:      The query variable.
+        e:      Dictionary of evidence variables and observed values.
+        n:      Number of samples for the sampling algorithms
+        seed:   Seed of the random number generator of the sampling algorithms
+
+    Returns:
+        Distribution over the states of X
+    """
+    if alg in SAMPLERS:
+        return getattr(net, SAMPLERS[alg])(X, e, n=n, seed=seed)
+    if alg == 'enum':
+        return net.enum_ask(X, e)
+    if alg == 'elim':
+        return net.elim_ask(X, e)
+    raise ValueError('Unknown algorithm %s' % alg)
+
+def answerline(net, alg, q, n=10000, seed=None, lineno=None):
+    """
+    Answer a query line of a bulk query file; errors are reported in the
+    record rather than raised so that one bad line does not stop the others.
+
+    Args:
+        net:    Net
+        alg:    Algorithm to use, see query.
+        q:      Query, see query.
+        n:      Number of samples for the sampling algorithms
+        seed:   Seed of the random number generator of the sampling algorithms
+        lineno: Line number of the query.
+
+    Returns:
+        Dictionary {'line': lineno, 'query': q} with either 'distribution',
+        {value or comma-separated values: probability}, or 'assignment',
+        {variable: value}, and 'probability' for mpe and map, or 'error'
+    """
+    record = {'line': lineno, 'query': q}
+    try:
+        X, e = parsequery(q)
+        e = dict(e)
+        variables = [x.strip() for x in X.split(',')]
+        if alg == 'mpe' or alg == 'map':
+            values, prob = net.mpe(e) if alg == 'mpe' else net.map(variables, e)
+            record['assignment'] = dict((v, net.statename(v, x)) for v, x in values.items())
+            record['probability'] = net.conditional(prob, e)
+        elif len(variables) > 1:
+            if alg != 'enum' and alg != 'elim':
+                raise ValueError('Joint queries are answered by enum or elim')
+            dist = net.joint_ask(variables, e, alg)
+            record['distribution'] = dict((','.join(net.statename(v, x) for v, x in zip(variables, values)), p)
+                                          for values, p in dist.items())
+        else:
+            dist = answer(net, alg, X, e, n, seed)
+            record['distribution'] = dict(zip(net.net[X]['states'], (float(p) for p in dist)))
+    except Exception as err:
+        record['error'] = '%s: %s' % (type(err).__name__, err)
+    return record
+
+def bulkquery(net, alg, lines, out, fmt='jsonl', workers=None, n=10000, seed=None):
+    """
+    Answer queries read one per line, writing each result as soon as it is
+    known, in the order of the lines, so that memory stays bounded whatever
+    the number of lines. Blank lines and lines starting with # are skipped.
+
+    Args:
+        net:        Net
+        alg:        Algorithm to use, see query.
+        lines:      Iterable of query lines, e.g. a file.
+        out:        File to write the results to.
+        fmt:        'jsonl' for a JSON object per query, see answerline, or
+                    'csv' for rows line,query,value,probability,error with
+                    one row per value.
+        workers:    Number of worker processes, see NetPool, or None to
+                    answer in this process.
+        n, seed:    Number of samples and seed of the samplers.
+
+    Returns:
+        Number of queries answered
+    """
+    numbered = ((i + 1, line.strip()) for i, line in enumerate(lines))
+    numbered = ((i, q) for i, q in numbered if q != '' and not q.startswith('#'))
+    if fmt == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['line', 'query', 'value', 'probability', 'error'])
+
+    pool = None if workers is None else NetPool(net, workers)
+    try:
+        if pool is None:
+            records = (answerline(net, alg, q, n, seed, i) for i, q in numbered)
+        else:
+            records = pool.stream(numbered, alg, n=n, seed=seed)
+        count = 0
+        for record in records:
+            count += 1
+            if fmt == 'jsonl':
+                out.write(json.dumps(record) + '\n')
+            elif 'error' in record:
+                writer.writerow([record['line'], record['query'], '', '', record['error']])
+            elif 'assignment' in record:
+                writer.writerow([record['line'], record['query'],
+                                 ','.join('%s=%s' % v for v in record['assignment'].items()),
+                                 record['probability'], ''])
+            else:
+                for value, p in record['distribution'].items():
+                    writer.writerow([record['line'], record['query'], value, p, ''])
+            # a pipe would otherwise see the results in buffered chunks
+            out.flush()
+        return count
+    finally:
+        if pool is not None:
+            pool.close()
+
+def query(fname, alg, q, trace=None, n=10000, seed=None):
+    """
+    Construct the bayes net, query and return distr.
+
+    Args:
+        fname:  File name of the bayes net
+        alg:    Algorithm to use (enum, elim or one of SAMPLERS), or mpe for
+                the most probable explanation of the evidence, or map for the
+                most likely values of the variables of a query P(B,E|J=t)
+        q:      Query, with several variables for a joint distribution with
+                enum or elim, e.g. P(A,B|J=t)
+        trace:  Optional trace callback, see Net.__init__
+        n:      Number of samples for the sampling algorithms
+        seed:   Seed of the random number generator of the sampling algorithms
+    """
+    # construct the net from the given file name
+    try:
+        net = Net(fname, trace)
+    except:
+        print('Failed to parse %s' % fname)
+        exit()
+
+    # parse the given query
+    X, e = parsequery(q)
+
+    if alg == 'mpe' or alg == 'map':
+        edict = dict(e)
+        if alg == 'mpe':
+            values, prob = net.mpe(edict)
+        else:
+            values, prob = net.map([x.strip() for x in X.split(',')], edict)
+        prob = net.conditional(prob, edict)
+        print("\nRESULT:")
+        print("%s(%s | %s) = %.4f" %
+                (alg.upper(),
+                ', '.join('%s = %s' % (v, net.statename(v, x)) for v, x in values.items()),
+                ', '.join('%s = %s' % v for v in e),
+                prob))
+        return
+
+    variables = [x.strip() for x in X.split(',')]
+    if len(variables) > 1:
+        if alg != 'enum' and alg != 'elim':
+            print('Joint queries are answered by enum or elim')
+            exit()
+        dist = net.joint_ask(variables, dict(e), alg)
+        print("\nRESULT:")
+        for values, prob in dist.items():
+            print("P(%s | %s) = %.4f" %
+                    (', '.join('%s = %s' % (v, net.statename(v, x)) for v, x in zip(variables, values)),
+                    ', '.join('%s = %s' % v for v in e),
+                    prob))
+        return
+
+    # call the appropriate function
+    dist = answer(net, alg, X, dict(e), n, seed)
+    print("\nRESULT:")
+    for prob, x in zip(dist, net.net[X]['states']):
+        print("P(%s = %s | %s) = %.4f" %
+                (X,
+                x,
+                ', '.join('%s = %s' % v for v in e),
+                prob))
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a bayes net, or learn its CPTs from a CSV file.')
+    parser.add_argument('bayesnet', help='file of the bayes net')
+    parser.add_argument('alg', choices=['enum', 'elim', 'mpe', 'map', 'learn'] + sorted(SAMPLERS))
+    parser.add_argument('query', help="query, e.g. 'P(B|J=t,M=t)', or @file of queries, "
+                                      "one per line, or - to read them from the standard input")
+    # optional number of samples and seed for the sampling algorithms
+    parser.add_argument('samples', nargs='?', type=int, default=10000)
+    parser.add_argument('seed', nargs='?', type=int)
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl',
+                        help='output of the queries of a file, see bulkquery')
+    parser.add_argument('--workers', type=int,
+                        help='number of processes answering the queries of a file')
+    parser.add_argument('--alpha', type=float, default=0.0,
+                        help='pseudo-count of learn, see Net.learn')
+    parser.add_argument('--output', help='file the network is written to by learn')
+    args = parser.parse_args()
+
+    if args.alg == 'learn':
+        # the query is the CSV file of the data
+        net = Net(args.bayesnet)
+        net.learn(args.query, args.alpha)
+        if args.output is None:
+            sys.stdout.write(net.dumps())
+        else:
+            with open(args.output, 'w') as f:
+                f.write(net.dumps())
+        return
+
+    if args.query != '-' and not args.query.startswith('@'):
+        query(args.bayesnet, args.alg, args.query, printtrace, args.samples, args.seed)
+        return
+
+    try:
+        net = Net(args.bayesnet)
+    except:
+        print('Failed to parse %s' % args.bayesnet)
+        exit()
+    lines = sys.stdin if args.query == '-' else open(args.query[1:])
+    with lines:
+        bulkquery(net, args.alg, lines, sys.stdout, args.format, args.workers, args.samples, args.seed)
 
 if __name__=='__main__':
     # import doctest
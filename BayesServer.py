@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import sys, os, json, time, asyncio, threading, collections, concurrent.futures
+from BayesNet import Net, ResultCache, answerline
+
+# errors of the queries that are answered with the status 400 rather than 500
+CLIENTERRORS = (ValueError, KeyError, IndexError, TypeError, OSError)
+
+class NetCache:
+    """
+    Cache of the networks loaded by a server, keyed on their file names. A
+    network is read again when its file changes, and the least recently used
+    networks are dropped once there are more than `maxnets`.
+    """
+
+    def __init__(self, root='.', maxnets=16, compiled=False, results=None):
+        """
+        Args:
+            root:       Directory the file names of the networks are relative
+                        to; files outside of it are refused.
+            maxnets:    Number of networks kept loaded.
+            compiled:   Whether to load through the compiled .bnc files, see
+                        Net.readcached.
+            results:    ResultCache shared by the networks, see Net.results.
+        """
+        self.root = os.path.realpath(root)
+        self.maxnets = maxnets
+        self.compiled = compiled
+        self.results = results
+        self.nets = collections.OrderedDict()   # path -> (stat, Net)
+        self.lock = threading.Lock()
+
+    def get(self, fname):
+        """
+        Get the network of a file, loading it when needed.
+
+        Args:
+            fname:  File name of the bayes net, relative to the root.
+
+        Returns:
+            tuple (Net, whether it was already loaded)
+        """
+        path = os.path.realpath(os.path.join(self.root, fname))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError('Network %s is outside of %s' % (fname, self.root))
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.nets.get(path)
+            if entry is not None and entry[0] == stat:
+                self.nets.move_to_end(path)
+                return entry[1], True
+        net = Net(path, compiled=self.compiled)
+        net.results = self.results
+        with self.lock:
+            self.nets[path] = (stat, net)
+            self.nets.move_to_end(path)
+            while len(self.nets) > self.maxnets:
+                self.nets.popitem(last=False)
+        return net, False
+
+class BayesServer:
+    """
+    Server answering queries over HTTP, on a TCP port or a Unix socket, with
+    the networks kept loaded between queries. Queries are posted as JSON
+    objects
+        {"net": "alarm.bn", "alg": "elim", "query": "P(B|J=t,M=t)",
+         "samples": 10000, "seed": 1}
+    where alg, samples and seed are optional, and are answered with the
+    record of BayesNet.answerline, e.g.
+        {"query": ..., "distribution": {"f": ..., "t": ...},
+         "latency": seconds, "warm": whether the network was loaded}
+    with an assignment and its probability for mpe and map, and joint
+    distributions for queries such as P(A,B|J=t), or {"error": message}
+    with the status 400, or 500 when the query could not be answered for
+    another reason than the request. GET /stats reports the number of queries answered and
+    their latencies.
+    Queries run in a pool of threads so that several are answered at once.
+    """
+
+    def __init__(self, cache=None, workers=None):
+        """
+        Args:
+            cache:      NetCache, one over the current directory by default.
+            workers:    Number of threads answering queries.
+        """
+        self.cache = NetCache() if cache is None else cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.count = 0
+        self.errors = 0
+        self.latency = 0.0      # total latency of the queries answered
+        self.maxlatency = 0.0
+
+    def ask(self, request):
+        """
+        Answer a query, the same way as the query lines of BayesNet.
+
+        Args:
+            request:    Dictionary of the query, see BayesServer.
+
+        Returns:
+            Dictionary of the response, with an 'error' if the query could
+            not be answered
+        """
+        start = time.perf_counter()
+        net, warm = self.cache.get(request['net'])
+        response = answerline(net, request.get('alg', 'elim'), request['query'],
+                              int(request.get('samples', 10000)), request.get('seed'))
+        del response['line']
+        response['latency'] = time.perf_counter() - start
+        response['warm'] = warm
+        return response
+
+    async def respond(self, method, path, body):
+        """
+        Answer an HTTP request.
+
+        Returns:
+            tuple (status, dictionary of the response)
+        """
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method != 'POST':
+            return 404, {'error': 'Not found'}
+        try:
+            request = json.loads(body)
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, self.ask, request)
+        except CLIENTERRORS as err:
+            self.errors += 1
+            return 400, {'error': '%s: %s' % (type(err).__name__, err)}
+        except Exception as err:
+            self.errors += 1
+            return 500, {'error': '%s: %s' % (type(err).__name__, err)}
+        if 'error' in response:
+            # e.g. evidence of probability zero, or a query over maxfactor,
+            # are not errors of the client
+            self.errors += 1
+            client = response['error'].split(':')[0] in [e.__name__ for e in CLIENTERRORS]
+            return 400 if client else 500, response
+        self.count += 1
+        self.latency += response['latency']
+        self.maxlatency = max(self.maxlatency, response['latency'])
+        return 200, response
+
+    def stats(self):
+        """
+        Statistics of the queries answered so far.
+        """
+        return {
+            'queries': self.count,
+            'errors': self.errors,
+            'meanlatency': self.latency / self.count if self.count > 0 else 0.0,
+            'maxlatency': self.maxlatency,
+            'nets': len(self.cache.nets),
+            'hits': self.cache.results.hits if self.cache.results is not None else 0,
+            'misses': self.cache.results.misses if self.cache.results is not None else 0
+        }
+
+    async def handle(self, reader, writer):
+        """
+        Serve the HTTP requests of a connection, which is kept alive until
+        the client closes it.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.respond(method, path, body)
+                data = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % (status, b'OK' if status == 200 else b'Error', len(data)))
+                writer.write(data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, port=None, path=None, host='127.0.0.1'):
+        """
+        Start listening on a TCP port of host, or on the Unix socket path.
+
+        Returns:
+            asyncio.Server
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+def main():
+    try:
+        address = sys.argv[1]
+    except IndexError:
+        print('Not enough argument.')
+        print('Usage: %s <port|socket> [root]' % sys.argv[0])
+        exit()
+    root = sys.argv[2] if len(sys.argv) > 2 else '.'
+    server = BayesServer(NetCache(root, results=ResultCache()))
+
+    async def serve():
+        if address.isdigit():
+            listener = await server.start(port=int(address))
+        else:
+            listener = await server.start(path=address)
+        async with listener:
+            await listener.serve_forever()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__=='__main__':
+    main()
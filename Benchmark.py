@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import os, sys, json, time, platform, argparse, tempfile, itertools, tracemalloc
+import numpy as np
+from BayesNet import Net, BOOLEAN
+
+def randomnet(n, indegree=3, width=5, states=2, seed=None):
+    """
+    Generate a random network in the format read by Net.read. Variable i
+    draws up to `indegree` parents among the `width` variables before it, so
+    the treewidth of the network is at most `width`. The CPTs are drawn
+    uniformly from the simplex.
+
+    Args:
+        n:          Number of variables.
+        indegree:   Largest number of parents of a variable.
+        width:      Number of preceding variables parents are drawn from.
+        states:     Number of states of the variables; 2 for boolean ones.
+        seed:       Seed of the random number generator.
+
+    Returns:
+        String
+    """
+    rng = np.random.default_rng(seed)
+    names = ['V%0*d' % (len(str(n - 1)), i) for i in range(n)]
+    statenames = BOOLEAN if states == 2 else ['s%d' % k for k in range(states)]
+    blocks = []
+    for i, v in enumerate(names):
+        window = names[max(0, i - width):i]
+        parents = sorted(rng.choice(window, min(len(window), rng.integers(0, indegree + 1)), replace=False))
+        name = v if states == 2 else '%s = %s' % (v, ' '.join(statenames))
+        def probs():
+            dist = rng.dirichlet(np.ones(states))
+            return '%.6f' % dist[1] if states == 2 else ' '.join('%.6f' % p for p in dist)
+        if len(parents) == 0:
+            blocks.append('P(%s) = %s\n' % (name, probs()))
+        else:
+            header = '%s | %s\n' % (' '.join(parents), name)
+            rows = [header, '-' * (len(header) - 1) + '\n']
+            for values in itertools.product(statenames, repeat=len(parents)):
+                rows.append('%s | %s\n' % (' '.join(values), probs()))
+            blocks.append(''.join(rows))
+    return '\n'.join(blocks)
+
+def randomqueries(net, count, evidence, seed=None):
+    """
+    Draw random queries: a query variable and `evidence` other variables with
+    random values.
+
+    Returns:
+        List of (X, e)
+    """
+    rng = np.random.default_rng(seed)
+    names = sorted(net.net)
+    queries = []
+    for _ in range(count):
+        chosen = rng.choice(names, min(len(names), evidence + 1), replace=False)
+        X = str(chosen[0])
+        e = dict((str(v), int(rng.integers(len(net.net[v]['states'])))) for v in chosen[1:])
+        queries.append((X, e))
+    return queries
+
+def measure(fn, runs):
+    """
+    Time the runs of a function, and its peak memory over one more run.
+
+    Args:
+        fn:     Function called with the index of the run.
+        runs:   Number of runs.
+
+    Returns:
+        Dictionary of the statistics of the latencies, in seconds, the
+        throughput, in runs per second, and the peak memory, in bytes
+    """
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn(0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times = np.array(times)
+    return {
+        'runs': runs,
+        'total': float(times.sum()),
+        'mean': float(times.mean()),
+        'p50': float(np.percentile(times, 50)),
+        'p90': float(np.percentile(times, 90)),
+        'p99': float(np.percentile(times, 99)),
+        'max': float(times.max()),
+        'throughput': runs / float(times.sum()) if times.sum() > 0 else None,
+        'peakmemory': peak
+    }
+
+ENGINES = ['init', 'indexes', 'toposort', 'enum', 'elim', 'elimcold', 'logelim', 'junctiontree', 'likelihood']
+
+def benchmark(n, indegree=3, width=5, states=2, queries=20, evidence=5, seed=0,
+              engines=ENGINES, enumlimit=100, samples=1000):
+    """
+    Benchmark the engines on a random network.
+
+    Args:
+        n, indegree, width, states:     Shape of the network, see randomnet.
+        queries:    Number of random queries per engine.
+        evidence:   Number of evidence variables of the queries.
+        seed:       Seed of the network and the queries.
+        engines:    Names of the engines to run, among ENGINES:
+                        init -> Net.__init__ reading the file
+                        indexes -> Net.buildindexes
+                        toposort -> Net.toposort
+                        enum -> enum_ask
+                        elim -> elim_ask with the plans cached
+                        elimcold -> elim_ask compiling each plan
+                        logelim -> elim_ask in log space
+                        junctiontree -> building and calibrating a junction
+                            tree for each evidence set
+                        likelihood -> likelihood_ask with `samples` samples
+        enumlimit:  Largest network enum is run on.
+        samples:    Number of samples of the sampling engines.
+
+    Returns:
+        Dictionary {engine: statistics, see measure}
+    """
+    text = randomnet(n, indegree, width, states, seed)
+    with tempfile.NamedTemporaryFile('w', suffix='.bn', delete=False) as f:
+        f.write(text)
+    try:
+        net = Net(f.name)
+        qs = randomqueries(net, queries, evidence, seed)
+        def elimcold(i):
+            net.plans.clear()
+            net.elim_ask(*qs[i])
+        def logelim(i):
+            net.logspace = True
+            try:
+                net.elim_ask(*qs[i])
+            finally:
+                net.logspace = False
+        def junctiontree(i):
+            tree = net.junctiontree()
+            tree.setevidence(qs[i][1])
+            tree.marginals()
+        runs = {
+            'init': (lambda i: Net(f.name), 5),
+            'indexes': (lambda i: net.buildindexes(), 5),
+            'toposort': (lambda i: net.toposort(), 5),
+            'enum': (lambda i: net.enum_ask(*qs[i]), queries),
+            'elim': (lambda i: net.elim_ask(*qs[i]), queries),
+            'elimcold': (elimcold, queries),
+            'logelim': (logelim, queries),
+            'junctiontree': (junctiontree, min(queries, 5)),
+            'likelihood': (lambda i: net.likelihood_ask(*qs[i], n=samples, seed=i), queries)
+        }
+        results = {}
+        for engine in engines:
+            if engine == 'enum' and n > enumlimit:
+                continue
+            if engine in ('elim', 'logelim'):
+                for X, e in qs:
+                    net.compile(X, e)
+            fn, count = runs[engine]
+            results[engine] = measure(fn, count)
+        return results
+    finally:
+        os.remove(f.name)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the inference engines on random networks.')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10, 100, 1000],
+                        help='numbers of variables of the networks')
+    parser.add_argument('--indegree', type=int, default=3, help='largest number of parents')
+    parser.add_argument('--width', type=int, default=5, help='bound on the treewidth')
+    parser.add_argument('--states', type=int, default=2, help='number of states of the variables')
+    parser.add_argument('--queries', type=int, default=20, help='number of queries per engine')
+    parser.add_argument('--evidence', type=int, default=5, help='number of evidence variables')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES)
+    parser.add_argument('--enumlimit', type=int, default=100, help='largest network enum is run on')
+    parser.add_argument('--samples', type=int, default=1000, help='number of samples of the samplers')
+    parser.add_argument('--output', help='file to write the report to, standard output by default')
+    args = parser.parse_args()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('sizes', 'output')),
+        'results': []
+    }
+    for n in args.sizes:
+        results = benchmark(n, args.indegree, args.width, args.states, args.queries, args.evidence,
+                            args.seed, args.engines, args.enumlimit, args.samples)
+        report['results'].append({'n': n, 'engines': results})
+        print('n=%d %s' % (n, ' '.join('%s=%.2gs' % (k, r['p50']) for k, r in results.items())),
+              file=sys.stderr)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__=='__main__':
+    main()
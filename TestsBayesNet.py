@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
-import unittest
-from BayesNet import Net
+import unittest, io, contextlib, os, json, tempfile, itertools
+import numpy as np
+from BayesNet import Net, Factor, NetPool, ResultCache, QueryStats, MISSING, query, bulkquery, answerline
 
 '''
 Test methods:
@@ -22,6 +23,7 @@ class TestBayesNet(unittest.TestCase):
     def setUp(self):
         self.net_alarm = Net('alarm.bn')
         self.net_ex2 = Net('ex2.bn')
+        self.net_ex3 = Net('ex3.bn')
 
     def test_parse(self):
         # func(self)
@@ -69,13 +71,12 @@ class TestBayesNet(unittest.TestCase):
         for i, o in cases:
             self.assertAlmostEqual(self.net_ex2.querygiven(*i), o)
 
-    def test_genpermutations(self):
-        cases = [0, 1, 2, 5]
-        for c in cases:
-            res = self.net_alarm.genpermutations(c)
-            for r in res:
-                self.assertEqual(len(r), c)
-            self.assertEqual(len(set(res)), len(res))
+    def test_factor_fromdict0(self):
+        entries = {(True, True): 0.7, (True, False): 0.3, (False, True): 0.1, (False, False): 0.9}
+        res = Factor.fromdict(['A', 'D'], entries)
+        np.testing.assert_array_equal(res.values, [[0.9, 0.1], [0.3, 0.7]])
+        self.assertEqual(res.todict(), entries)
+        self.assertEqual(Factor.fromdict([], {(): 0.5}).todict(), {(): 0.5})
 
     def test_makefactor0(self):
         i = ('D', {'D': ['D', 'A']}, {'B': True})
@@ -98,6 +99,696 @@ class TestBayesNet(unittest.TestCase):
             (True, False): 0.3, (False, True): 0.1, (False, False): 0.9})]),
         [(['A'], {(False,): 1.0, (True,): 1.0})])
 
+    def test_cptfactor0(self):
+        res = self.net_ex2.cptfactor('D', {'B': True})
+        self.assertEqual(res.variables, ['A', 'D'])
+        np.testing.assert_allclose(res.values, [[0.9, 0.1], [0.3, 0.7]])
+
+    def test_factor_pointwise0(self):
+        f1 = Factor(['C', 'E'], np.array([[0.8, 0.2], [0.3, 0.7]]))
+        f2 = Factor(['A', 'C'], np.array([[0.6, 0.4], [0.2, 0.8]]))
+        res = f1.pointwise(f2)
+        self.assertEqual(res.variables, ['A', 'C', 'E'])
+        o = self.net_ex2.pointwise('C',
+            (f1.variables, dict(f1.entries())), (f2.variables, dict(f2.entries())))
+        for asg, prob in res.entries():
+            self.assertAlmostEqual(prob, o[1][asg])
+
+    def test_factor_sumout0(self):
+        res = Factor(['A', 'D'], np.array([[0.9, 0.1], [0.3, 0.7]])).sumout('D')
+        self.assertEqual(res.variables, ['A'])
+        self.assertEqual(dict(res.entries()), {(False,): 1.0, (True,): 1.0})
+
+    def test_ex2_ask1(self):
+        inputs = [
+            ('D', {'C': True}),
+            ('A', {'E': False, 'B': True}),
+            ('E', {}),
+            ('C', {'D': True})
+        ]
+        for i in inputs:
+            res1 = self.net_ex2.enum_ask(*i)
+            res2 = self.net_ex2.elim_ask(*i)
+            self.assertAlmostEqual(res1[0], res2[0])
+            self.assertAlmostEqual(res1[1], res2[1])
+
+    def test_trace0(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.net_alarm.enum_ask('B', {'J': True})
+            self.net_alarm.elim_ask('B', {'J': True})
+        self.assertEqual(out.getvalue(), '')
+
+        msgs = []
+        self.net_alarm.trace = lambda msg, *args: msgs.append(msg % args)
+        self.net_alarm.elim_ask('B', {'J': True})
+        self.assertIn('Pruned 1 of 5 variables', msgs)
+        self.assertIn('----- Variable: J -----', msgs)
+        self.assertNotIn('----- Variable: M -----', msgs)
+
+    def test_compile0(self):
+        plan = self.net_alarm.compile('B', {'J': True, 'M': False})
+        self.assertIs(self.net_alarm.compile('B', ['M', 'J']), plan)
+        self.assertEqual([s[0] for s in plan.steps], ['J', 'M', 'A', 'B', 'E'])
+        for e in [{'J': True, 'M': False}, {'J': False, 'M': True}]:
+            res1 = plan.run(self.net_alarm, e)
+            res2 = self.net_alarm.enum_ask('B', e)
+            self.assertAlmostEqual(res1[0], res2[0])
+            self.assertAlmostEqual(res1[1], res2[1])
+
+    def test_compile1(self):
+        self.net_alarm.maxplans = 2
+        for X in ['A', 'B', 'E', 'B']:
+            self.net_alarm.compile(X, [])
+        self.assertEqual(list(self.net_alarm.plans.keys()),
+            [('E', frozenset(), 'greedy', True), ('B', frozenset(), 'greedy', True)])
+
+    def test_batch_ask0(self):
+        inputs = [
+            {'J': False, 'M': True},
+            {'A': True},
+            {'A': True, 'M': False},
+            {}
+        ]
+        variables = ['A', 'B', 'E', 'J', 'M']
+        for X in ['B', 'E']:
+            rows = [[int(e[v]) if v in e else MISSING for v in variables] for e in inputs]
+            res = self.net_alarm.batch_ask(X, rows)
+            self.assertEqual(res.shape, (len(inputs), 2))
+            for r, e in zip(res, inputs):
+                o = self.net_alarm.enum_ask(X, e)
+                self.assertAlmostEqual(r[0], o[0])
+                self.assertAlmostEqual(r[1], o[1])
+
+    def test_batch_ask1(self):
+        res = self.net_ex2.batch_ask('A', [[1, MISSING], [0, 1]], ['D', 'C'])
+        o = self.net_ex2.elim_ask('A', {'C': True, 'D': False})
+        self.assertAlmostEqual(res[1][0], o[0])
+        self.assertAlmostEqual(res[1][1], o[1])
+
+    def test_batch_ask2(self):
+        # plans ordered on the interaction graph
+        net = self.net_alarm
+        net.heuristic = 'minfill'
+        rows = [[MISSING, MISSING, MISSING, 1, 1], [1, MISSING, 0, MISSING, MISSING]]
+        res = net.batch_ask('B', rows)
+        for r, e in zip(res, [{'J': True, 'M': True}, {'A': True, 'E': False}]):
+            for a, b in zip(r, net.enum_ask('B', e)):
+                self.assertAlmostEqual(a, b)
+
+    def test_junctiontree0(self):
+        for net in [self.net_alarm, self.net_ex2]:
+            jt = net.junctiontree()
+            for v in net.net:
+                family = set(net.net[v]['parents'] + [v])
+                self.assertTrue(family <= set(jt.cliques[jt.home[v]]))
+            for e in [{}, {'A': True}, {'B': False, 'E': True}]:
+                jt.setevidence(e)
+                res = jt.marginals()
+                for X in net.net:
+                    if X not in e:
+                        o = net.elim_ask(X, e)
+                        self.assertAlmostEqual(res[X][0], o[0])
+                        self.assertAlmostEqual(res[X][1], o[1])
+
+    def test_junctiontree1(self):
+        jt = self.net_alarm.junctiontree()
+        jt.setevidence({'J': True, 'M': False})
+        jt.calibrate()
+        self.assertEqual(len(jt.messages), len(jt.schedule))
+        jt.setevidence({'J': True, 'M': True})
+        # only the messages leaving the clique of M are recomputed
+        self.assertEqual(len(jt.messages), len(jt.schedule) - len(jt.cliques) + 1)
+        res = jt.marginals()['B']
+        o = self.net_alarm.enum_ask('B', {'J': True, 'M': True})
+        self.assertAlmostEqual(res[0], o[0])
+        self.assertAlmostEqual(res[1], o[1])
+
+    def test_heuristics0(self):
+        for net in [self.net_alarm, self.net_ex2]:
+            for h in ['greedy', 'auto', 'mindegree', 'minweight', 'minfill', 'weightedminfill']:
+                for X, e in [('A', {}), ('B', {'C': True}), ('E', {'A': True, 'D': False})]:
+                    if X in net.net and all(v in net.net for v in e):
+                        res1 = net.compile(X, e, h).run(net, e)
+                        res2 = net.enum_ask(X, e)
+                        self.assertAlmostEqual(res1[0], res2[0])
+                        self.assertAlmostEqual(res1[1], res2[1])
+
+    def test_plan_cost0(self):
+        res = self.net_alarm.plan_cost('B', {'J': True, 'M': True})
+        self.assertEqual(res['order'], ['A', 'E'])
+        self.assertEqual(res['width'], 2)
+        self.assertEqual(res['maxfactor'], 8)
+        res = self.net_alarm.plan_cost('J', {}, 'minfill')
+        self.assertEqual(sorted(res['order']), ['A', 'B', 'E'])
+        self.assertEqual(res['maxfactor'], 8)
+        self.assertEqual(res['pruned'], 1)
+
+    def test_dseparated0(self):
+        cases = [
+            ((['B'], ['E'], []), True),
+            ((['B'], ['E'], ['A']), False),
+            ((['B'], ['E'], ['J']), False),
+            ((['J'], ['M'], ['A']), True),
+            ((['J'], ['B'], ['A']), True),
+            ((['J'], ['B'], []), False)
+        ]
+        for i, o in cases:
+            self.assertEqual(self.net_alarm.dseparated(*i), o)
+
+    def test_relevant0(self):
+        cases = [
+            ((self.net_alarm, 'B', {'J': True, 'A': True}), ({'A', 'B', 'E'}, {'A'})),
+            ((self.net_alarm, 'B', {'J': True}), ({'A', 'B', 'E', 'J'}, {'J'})),
+            ((self.net_alarm, 'E', {'B': True}), ({'E'}, set())),
+            ((self.net_ex2, 'C', {'E': True, 'D': False}), ({'A', 'B', 'C', 'D', 'E'}, {'D', 'E'}))
+        ]
+        for (net, X, e), o in cases:
+            self.assertEqual(net.relevant(X, e), o)
+
+    def test_prune0(self):
+        inputs = [
+            ('B', {'J': True, 'A': True}),
+            ('E', {'B': True}),
+            ('M', {'J': False})
+        ]
+        for X, e in inputs:
+            self.net_alarm.pruning = True
+            res1 = self.net_alarm.enum_ask(X, e)
+            res2 = self.net_alarm.elim_ask(X, e)
+            self.net_alarm.pruning = False
+            o = self.net_alarm.enum_ask(X, e)
+            for res in [res1, res2]:
+                self.assertAlmostEqual(res[0], o[0])
+                self.assertAlmostEqual(res[1], o[1])
+
+    def test_enum_all0(self):
+        # a chain deeper than the recursion limit
+        n = 1200
+        with tempfile.NamedTemporaryFile('w', suffix='.bn', delete=False) as f:
+            f.write('P(V0000) = 0.3\n')
+            for i in range(1, n):
+                f.write('\nV%04d | V%04d\n-----\nt | 0.9\nf | 0.2\n' % (i - 1, i))
+        try:
+            net = Net(f.name)
+        finally:
+            os.remove(f.name)
+        res = net.enum_ask('V0000', {'V%04d' % (n - 1): True})
+        o = np.array([0.7, 0.3]) * np.linalg.matrix_power([[0.8, 0.2], [0.1, 0.9]], n - 1)[:, 1]
+        self.assertAlmostEqual(res[0], o[0] / o.sum())
+        self.assertAlmostEqual(res[1], o[1] / o.sum())
+
+    def test_enum_all1(self):
+        e = {'J': True, 'M': False, 'B': True}
+        o = self.net_alarm.enum_all(self.net_alarm.toposort(), e)
+        self.assertAlmostEqual(o, 0.001 * 0.25677441)
+        self.assertEqual(e, {'J': True, 'M': False, 'B': True})
+
+    def test_prior_sample0(self):
+        res = self.net_ex2.prior_sample(100000, seed=0)
+        self.assertEqual(sorted(res.keys()), ['A', 'B', 'C', 'D', 'E'])
+        self.assertAlmostEqual(res['A'].mean(), 0.3, places=2)
+        self.assertAlmostEqual(res['C'][res['A'] == 1].mean(), 0.8, places=2)
+
+    def test_sampling_ask0(self):
+        inputs = [
+            ('A', {'D': True}),
+            ('C', {'E': False, 'B': True}),
+            ('D', {'C': True})
+        ]
+        for X, e in inputs:
+            o = self.net_ex2.elim_ask(X, e)
+            for ask in [self.net_ex2.rejection_ask, self.net_ex2.likelihood_ask,
+                        self.net_ex2.gibbs_ask]:
+                res = ask(X, e, n=50000, seed=1)
+                self.assertAlmostEqual(res[1], o[1], delta=0.02)
+                self.assertAlmostEqual(res[0] + res[1], 1.0)
+                self.assertEqual(ask(X, e, n=1000, seed=2), ask(X, e, n=1000, seed=2))
+
+    def test_sampling_ask2(self):
+        # evidence of probability zero
+        net = Net(None)
+        net.read(['P(A) = 0.0\n', '\n', 'A | B\n', '-----\n', 't | 0.5\n', 'f | 0.5\n'])
+        for ask in [net.rejection_ask, net.likelihood_ask, net.gibbs_ask]:
+            with self.assertRaises(ValueError):
+                ask('B', {'A': True}, n=1000, seed=1)
+
+    def test_impossible0(self):
+        # evidence of probability zero raises in every exact engine
+        net = Net(None)
+        net.read(['P(A) = 0.0\n', '\n', 'A | B\n', '-----\n', 't | 0.5\n', 'f | 0.5\n'])
+        tree = net.junctiontree()
+        tree.setevidence({'A': True})
+        with self.assertRaises(ZeroDivisionError):
+            tree.marginals()
+        for log in [False, True]:
+            net.logspace = log
+            with self.assertRaises(ZeroDivisionError):
+                net.enum_ask('B', {'A': True})
+            with self.assertRaises(ZeroDivisionError):
+                net.batch_ask('B', [[0, MISSING], [1, MISSING]])
+
+    def test_sampling_ask1(self):
+        # stops early once the standard error is small enough
+        draws = []
+        def draw(size):
+            draws.append(size)
+            return np.arange(size) % 2, np.ones(size)
+        res = self.net_ex2.estimate(draw, 2, 100000, 0.01, batch=1000)
+        self.assertEqual(res.tolist(), [1500, 1500])
+        self.assertEqual(len(draws), 3)
+
+    def test_dumps0(self):
+        for net in [self.net_alarm, self.net_ex2, self.net_ex3]:
+            res = Net(None)
+            res.read(net.dumps().splitlines(True))
+            for v in net.net:
+                self.assertEqual(res.net[v]['parents'], net.net[v]['parents'])
+                self.assertEqual(res.net[v]['children'], net.net[v]['children'])
+                np.testing.assert_array_equal(res.net[v]['cpt'], net.net[v]['cpt'])
+
+    def test_netpool0(self):
+        inputs = [
+            ('B', {'J': False, 'M': True}),
+            ('A', {'B': True, 'E': False, 'J': True, 'M': True}),
+            ('M', {'B': False, 'E': False}),
+            ('E', {'B': True}),
+            ('E', {'A': True, 'M': False})
+        ]
+        with NetPool(self.net_alarm, workers=2) as pool:
+            res = list(pool.ask(inputs, chunksize=2))
+            self.assertEqual(len(res), len(inputs))
+            for r, i in zip(res, inputs):
+                o = self.net_alarm.elim_ask(*i)
+                self.assertAlmostEqual(r[0], o[0])
+                self.assertAlmostEqual(r[1], o[1])
+            o = self.net_alarm.elim_ask('A', {'M': True})
+            res = pool.sample_ask('likelihood', 'A', {'M': True}, n=40000, seed=3)
+            self.assertAlmostEqual(res[1], o[1], delta=0.02)
+            self.assertEqual(res, pool.sample_ask('likelihood', 'A', {'M': True}, n=40000, seed=3))
+
+    def test_querygiven_ex3(self):
+        cases = [
+            (('Weather', {'Weather': 'rain'}), 0.3),
+            (('Holiday', {'Holiday': True}), 0.2),
+            (('Traffic', {'Weather': 'snow', 'Holiday': False, 'Traffic': 'high'}), 0.7),
+            (('Traffic', {'Weather': 1, 'Holiday': True, 'Traffic': 0}), 0.4),
+            (('Late', {'Traffic': 'mid', 'Late': 'f'}), 0.8)
+        ]
+        for i, o in cases:
+            self.assertAlmostEqual(self.net_ex3.querygiven(*i), o)
+
+    def test_ex3_ask1(self):
+        net = self.net_ex3
+        inputs = [
+            ('Weather', {'Late': True, 'Umbrella': False}),
+            ('Traffic', {'Late': 't', 'Weather': 'snow'}),
+            ('Holiday', {'Traffic': 'high'}),
+            ('Late', {})
+        ]
+        outputs = [
+            (0.7065, 0.1285, 0.1650),
+            (0.0088, 0.1150, 0.8761),
+            (0.8889, 0.1111),
+            (0.7202, 0.2798)
+        ]
+        variables = sorted(net.net.keys())
+        for (X, e), o in zip(inputs, outputs):
+            jt = net.junctiontree()
+            jt.setevidence(e)
+            row = [[net.index(v, e[v]) if v in e else MISSING for v in variables]]
+            for res in [net.enum_ask(X, e), net.elim_ask(X, e),
+                        net.compile(X, e, 'weightedminfill').run(net, e),
+                        jt.marginals()[X], net.batch_ask(X, row)[0]]:
+                self.assertEqual(len(res), len(o))
+                for r, p in zip(res, o):
+                    self.assertEqual(round(r - p, 3), 0)
+            res = net.likelihood_ask(X, e, n=50000, seed=0)
+            for r, p in zip(res, o):
+                self.assertAlmostEqual(r, p, delta=0.02)
+
+    def test_compiled0(self):
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'net.bn')
+            with open(fname, 'w') as f:
+                f.write(self.net_ex3.dumps())
+            for i in range(2):
+                # written the first time, loaded the second time
+                net = Net(fname, compiled=True)
+                self.assertTrue(os.path.exists(fname + 'c'))
+                self.assertEqual(net.dumps(), self.net_ex3.dumps())
+            self.assertFalse(net.net['Late']['cpt'].flags.writeable)
+            self.assertEqual(Net(fname + 'c').dumps(), self.net_ex3.dumps())
+            res = net.elim_ask('Weather', {'Late': True})
+            o = self.net_ex3.elim_ask('Weather', {'Late': True})
+            self.assertEqual(res, o)
+
+            # changing the network file invalidates the compiled form
+            with open(fname, 'w') as f:
+                f.write(self.net_ex2.dumps())
+            os.utime(fname, ns=(0, 0))
+            self.assertEqual(Net(fname, compiled=True).dumps(), self.net_ex2.dumps())
+            self.assertEqual(Net(fname + 'c').dumps(), self.net_ex2.dumps())
+
+    def test_compiled1(self):
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'net.bn')
+            with open(fname, 'w') as f:
+                f.write('P(X = f t) = 0.4 0.6\n\nX | Y\n-----\nt | 0.3\nf | 0.9\n')
+            # a corrupt compiled form is parsed over
+            with open(fname + 'c', 'wb') as f:
+                f.write(b'BNC2\x01')
+            net = Net(fname, compiled=True)
+            self.assertEqual(net.value('X', 1), 't')
+            # the declared states f t are not taken for a boolean variable
+            loaded = Net(fname + 'c')
+            self.assertEqual(loaded.value('X', 1), 't')
+            self.assertEqual(loaded.value('Y', 1), True)
+            self.assertEqual(loaded.dumps(), net.dumps())
+            self.assertIn('P(X = f t) = 0.4 0.6', net.dumps())
+            # the compiled form is skipped when it cannot be written
+            os.remove(fname + 'c')
+            os.mkdir(fname + 'c')
+            self.assertEqual(Net(fname, compiled=True).dumps(), net.dumps())
+            self.assertEqual(sorted(os.listdir(d)), ['net.bn', 'net.bnc'])
+
+    def test_buildindexes0(self):
+        g = self.net_alarm.graph
+        self.assertEqual(g.names, ('A', 'B', 'E', 'J', 'M'))
+        self.assertEqual(g.parents[g.ids['A']], (g.ids['B'], g.ids['E']))
+        self.assertEqual(g.children[g.ids['A']], (g.ids['J'], g.ids['M']))
+        self.assertEqual(self.net_alarm.ancestors(['J']), {'A', 'B', 'E', 'J'})
+        self.assertEqual(self.net_alarm.ancestors(['B', 'E']), {'B', 'E'})
+        sub = self.net_alarm.subnet({'A', 'B', 'E'})
+        self.assertEqual(sub.graph.names, ('A', 'B', 'E'))
+        self.assertEqual(sub.toposort(), ['B', 'E', 'A'])
+
+    def test_toposort2(self):
+        # same order as repeatedly adding the variables whose parents have
+        # been added, in alphabetical order
+        for seed in range(20):
+            rng = np.random.default_rng(seed)
+            names = ['V%02d' % i for i in rng.permutation(30)]
+            net = Net(None)
+            lines = []
+            for i, v in enumerate(names):
+                parents = sorted(rng.choice(names[:i], min(i, 2), replace=False)) if i > 0 else []
+                if len(parents) == 0:
+                    lines.append('P(%s) = 0.5\n\n' % v)
+                else:
+                    lines.append('%s | %s\n--\n' % (' '.join(parents), v))
+                    lines.extend('%s | 0.5\n' % ' '.join(r) for r in itertools.product('tf', repeat=len(parents)))
+                    lines.append('\n')
+            net.read(lines)
+            o = []
+            while len(o) < len(names):
+                for v in sorted(names):
+                    if v not in o and all(p in o for p in net.net[v]['parents']):
+                        o.append(v)
+            self.assertEqual(net.toposort(), o)
+
+    def test_resultcache0(self):
+        net = self.net_alarm
+        net.results = ResultCache()
+        o = net.elim_ask('B', {'J': True, 'M': True})
+        self.assertEqual(net.elim_ask('B', {'M': 't', 'J': 't'}), o)
+        self.assertEqual(net.enum_ask('B', {'J': True, 'M': True}), net.enum_ask('B', {'M': 1, 'J': 1}))
+        self.assertEqual((net.results.hits, net.results.misses), (2, 2))
+        # the CPTs are read-only, and the cache is keyed on their values
+        with self.assertRaises(ValueError):
+            net.net['B']['cpt'][1] = 0.5
+        other = Net(None)
+        other.read(net.dumps().replace('P(B) = 0.001', 'P(B) = 0.5').splitlines(True))
+        other.results = net.results
+        self.assertNotEqual(other.fingerprint(), net.fingerprint())
+        self.assertNotEqual(other.elim_ask('B', {'J': True, 'M': True}), o)
+        self.assertEqual(net.results.misses, 3)
+        self.assertEqual(Net('alarm.bn').fingerprint(), net.fingerprint())
+
+    def test_resultcache1(self):
+        now = [0.0]
+        cache = ResultCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        self.assertEqual(cache.ask('a', lambda: 1), 1)
+        self.assertEqual(cache.ask('a', lambda: 2), 1)
+        now[0] = 10
+        self.assertEqual(cache.ask('a', lambda: 3), 3)
+        cache.ask('b', lambda: 4)
+        cache.ask('c', lambda: 5)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_setcpt0(self):
+        net = self.net_alarm
+        net.results = ResultCache()
+        e = {'J': True, 'M': True}
+        net.elim_ask('B', e)
+        fingerprint = net.fingerprint()
+        plan = net.compile('B', e)
+        tree = net.junctiontree()
+        tree.setevidence(e)
+        tree.calibrate()
+        net.setprob('A', {'B': True, 'E': False}, 0.5)
+        # only the messages away from the clique of A are dropped
+        self.assertEqual(sorted(tree.messages), [(0, 2), (1, 0)])
+        net.setcpt('M', [[0.9, 0.1], [0.2, 0.8]])
+        text = net.dumps()
+        self.assertIn('t f | 0.5\n', text)
+        other = Net(None)
+        other.read(text.splitlines(True))
+        marginals = tree.marginals()
+        for v in other.net:
+            if v not in e:
+                o = other.elim_ask(v, e)
+                self.assertEqual(net.elim_ask(v, e), o)
+                self.assertEqual(net.enum_ask(v, e, cache=False), other.enum_ask(v, e))
+                for a, b in zip(marginals[v], o):
+                    self.assertAlmostEqual(a, b)
+        self.assertIs(net.compile('B', e), plan)
+        self.assertNotEqual(net.fingerprint(), fingerprint)
+        with self.assertRaises(ValueError):
+            net.setcpt('B', [0.5, 0.6])
+        with self.assertRaises(ValueError):
+            net.setcpt('B', [[0.5, 0.5]])
+
+    def test_logspace0(self):
+        # the probability of the evidence underflows without log space
+        n = 400
+        net = Net(None)
+        net.read(['P(R) = 0.5\n'] + ['\nR | C%03d\n-----\nt | 0.01\nf | 0.02\n' % i for i in range(n)])
+        e = dict(('C%03d' % i, True) for i in range(n))
+        with self.assertRaises(ZeroDivisionError):
+            net.elim_ask('R', e)
+        net.logspace = True
+        o = 1 / (1 + 2.0 ** n)
+        with NetPool(net, workers=1) as pool:
+            pooled = list(pool.ask([('R', e)]))[0]
+        batch = net.batch_ask('R', [[1] * n + [MISSING]], sorted(e) + ['R'])[0]
+        for res in [net.elim_ask('R', e), net.enum_ask('R', e), pooled, batch]:
+            self.assertAlmostEqual(res[1] / o, 1.0)
+            self.assertAlmostEqual(res[0], 1.0)
+        # same distributions as without log space
+        self.net_ex3.logspace = True
+        res = self.net_ex3.elim_ask('Weather', {'Late': 't', 'Umbrella': 'f'})
+        enum = self.net_ex3.enum_ask('Weather', {'Late': 't', 'Umbrella': 'f'})
+        for a, b, c in zip(res, enum, (0.7065, 0.1285, 0.1650)):
+            self.assertAlmostEqual(a, b)
+            self.assertAlmostEqual(a, c, places=4)
+
+    def test_factor_log0(self):
+        f1 = Factor(['A', 'B'], np.log([[0.1, 0.2], [0.3, 0.4]]), log=True)
+        f2 = Factor(['B'], np.array([np.log(0.5), -np.inf]), log=True)
+        res = f1.pointwise(f2).sumout('B')
+        self.assertTrue(res.log)
+        np.testing.assert_allclose(np.exp(res.values), [0.05, 0.15])
+        self.assertEqual([p for _, p in f2.entries()], [0.5, 0.0])
+
+    def test_profile0(self):
+        net = self.net_alarm
+        e = {'J': True, 'M': True}
+        o = net.elim_ask('B', e)
+        collected = []
+        net.profile = collected.append
+        self.assertEqual(net.elim_ask('B', e), o)
+        stats = collected[0]
+        self.assertIsInstance(stats, QueryStats)
+        self.assertEqual(sorted(stats.times), sorted(QueryStats.PHASES))
+        self.assertTrue(all(t >= 0 for t in stats.times.values()))
+        self.assertGreater(stats.times['sumout'], 0)
+        # J and M make factors over A, then A, E and B are joined
+        self.assertEqual(max(stats.factorsizes), 8)
+        self.assertGreaterEqual(stats.peakbytes, 8 * 8)
+        self.assertIs(stats.plan, net.compile('B', e))
+
+    def test_cutset_ask0(self):
+        # C has 8 hidden parents, its factor has 256 entries whatever the order
+        hidden = ['H%d' % i for i in range(8)]
+        lines = ['P(X) = 0.3\n']
+        for i, h in enumerate(hidden):
+            lines.append('\nX | %s\n-----\nt | %.2f\nf | %.2f\n' % (h, 0.1 + 0.1 * i, 0.8 - 0.05 * i))
+        lines.append('\n%s | C\n-----\n' % ' '.join(hidden))
+        for k, values in enumerate(itertools.product('tf', repeat=8)):
+            lines.append('%s | %.3f\n' % (' '.join(values), (k * 37 % 100 + 1) / 102))
+        net = Net(None)
+        net.read(lines)
+        o = net.elim_ask('X', {'C': True})
+        net.plans.clear()
+        net.maxfactor = 64
+        collected = []
+        net.trace = lambda msg, *args: collected.append(msg % args)
+        res = net.elim_ask('X', {'C': True})
+        for a, b in zip(res, o):
+            self.assertAlmostEqual(a, b)
+        self.assertIn('Conditioning on H0 H1 H2', collected)
+        net.logspace = True
+        for a, b in zip(net.elim_ask('X', {'C': True}), o):
+            self.assertAlmostEqual(a, b)
+        net.maxconditions = 4
+        with self.assertRaises(MemoryError):
+            net.elim_ask('X', {'C': True})
+
+    def test_cutset_ask1(self):
+        # A in the cutset leaves the family of J all observed
+        net = self.net_alarm
+        net.maxfactor = 4
+        collected = []
+        net.trace = lambda msg, *args: collected.append(msg % args)
+        for a, b in zip(net.elim_ask('B', {'J': True}), (0.9837, 0.0163)):
+            self.assertAlmostEqual(a, b, places=4)
+        self.assertIn('Conditioning on A', collected)
+        net.trace = None
+        # queries over maxfactor are profiled too
+        profiled = []
+        net.profile = profiled.append
+        net.elim_ask('E', {'J': True})
+        self.assertEqual(len(profiled), 1)
+        self.assertLessEqual(profiled[0].plan.maxsize, 4)
+        self.assertLessEqual(max(profiled[0].factorsizes), 4)
+        self.assertGreater(profiled[0].times['ordering'], 0)
+        for X, e in [('E', {'J': True, 'M': False}), ('B', {'A': True}), ('J', {'M': True})]:
+            for a, b in zip(net.cutset_ask(X, e), net.enum_ask(X, e)):
+                self.assertAlmostEqual(a, b)
+
+    def test_mpe0(self):
+        # against the joint probabilities of all the assignments
+        net = self.net_ex3
+        e = {'Late': 't'}
+        hidden = ['Holiday', 'Traffic', 'Umbrella', 'Weather']
+        joints = {}
+        for values in itertools.product(*[range(len(net.net[v]['states'])) for v in hidden]):
+            asg = dict(e, **dict(zip(hidden, values)))
+            joints[values] = np.prod([net.querygiven(v, asg) for v in net.net])
+        best = max(joints, key=joints.get)
+        values, prob = net.mpe(e)
+        self.assertEqual(values, dict((v, net.value(v, i)) for v, i in zip(hidden, best)))
+        self.assertAlmostEqual(prob, joints[best])
+        net.logspace = True
+        self.assertAlmostEqual(net.mpe(e)[1], np.log(joints[best]))
+
+    def test_map0(self):
+        values, prob = self.net_alarm.map(['B', 'E'], {'J': True, 'M': True})
+        self.assertEqual(values, {'B': False, 'E': False})
+        self.assertAlmostEqual(prob, 0.0020841 * 0.5403, places=6)
+        values, prob = self.net_ex3.map(['Weather'], {'Late': 't'})
+        self.assertEqual(values, {'Weather': 'sun'})
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            query('alarm.bn', 'mpe', 'P(*|J=t,M=t)')
+            query('alarm.bn', 'map', 'P(B,E|J=t,M=t)')
+        self.assertEqual(out.getvalue(),
+            '\nRESULT:\nMPE(A = t, B = f, E = f | J = t, M = t) = 0.3014\n'
+            '\nRESULT:\nMAP(B = f, E = f | J = t, M = t) = 0.5403\n')
+        # the probability given the evidence, in log space too
+        net = self.net_alarm
+        e = {'J': True, 'M': True}
+        self.assertAlmostEqual(net.conditional(net.map(['B', 'E'], e)[1], e), 0.5403, places=4)
+        net.logspace = True
+        self.assertAlmostEqual(net.conditional(net.map(['B', 'E'], e)[1], e), 0.5403, places=4)
+        record = answerline(net, 'mpe', 'P(*|J=t,M=t)')
+        self.assertAlmostEqual(record['probability'], 0.3014, places=4)
+        zero = Net(None)
+        zero.read(['P(A) = 0.0\n', '\n', 'A | B\n', '-----\n', 't | 0.5\n', 'f | 0.5\n'])
+        with self.assertRaises(ValueError):
+            zero.conditional(0.0, {'A': True})
+        self.assertIn('probability zero', answerline(zero, 'map', 'P(B|A=t)')['error'])
+
+    def test_joint_ask0(self):
+        e = {'J': True}
+        res = self.net_alarm.joint_ask(['B', 'A'], e)
+        self.assertEqual(sorted(res), [(False, False), (False, True), (True, False), (True, True)])
+        self.assertAlmostEqual(sum(res.values()), 1.0)
+        for b, p in zip([False, True], self.net_alarm.elim_ask('B', e)):
+            self.assertAlmostEqual(res[(b, False)] + res[(b, True)], p)
+        for k, p in self.net_alarm.joint_ask(['B', 'A'], e, 'enum').items():
+            self.assertAlmostEqual(p, res[k])
+        res = self.net_ex3.joint_ask(['Traffic', 'Weather'], {'Late': 't'})
+        for w, p in zip(['sun', 'rain', 'snow'], self.net_ex3.elim_ask('Weather', {'Late': 't'})):
+            self.assertAlmostEqual(sum(res[(t, w)] for t in ['low', 'mid', 'high']), p)
+        with self.assertRaises(ValueError):
+            self.net_alarm.joint_ask(['B', 'J'], e)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            query('alarm.bn', 'elim', 'P(A,B|J=t)')
+        self.assertIn('P(A = t, B = t | J = t) = 0.0162\n', out.getvalue())
+
+    def test_bulkquery0(self):
+        lines = ['P(B|J=t,M=t)\n', '\n', '# comment\n', 'P(A,B|J=t)\n', 'P(Q|J=t)\n'] * 20
+        out = io.StringIO()
+        self.assertEqual(bulkquery(self.net_alarm, 'elim', iter(lines), out), 60)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['line'] for r in records[:4]], [1, 4, 5, 6])
+        self.assertAlmostEqual(records[0]['distribution']['t'], 0.2842, places=4)
+        self.assertAlmostEqual(records[1]['distribution']['t,t'], 0.0162, places=4)
+        self.assertIn('KeyError', records[2]['error'])
+        # flushed after each record
+        flushed = []
+        piped = io.StringIO()
+        piped.flush = lambda: flushed.append(piped.getvalue().count('\n'))
+        bulkquery(self.net_alarm, 'elim', lines[:5], piped)
+        self.assertEqual(flushed, [1, 2, 3])
+        # same records from the worker processes
+        parallel = io.StringIO()
+        bulkquery(self.net_alarm, 'elim', iter(lines), parallel, workers=2)
+        self.assertEqual(parallel.getvalue(), out.getvalue())
+        out = io.StringIO()
+        bulkquery(self.net_alarm, 'mpe', lines[:5], out, 'csv')
+        self.assertEqual(out.getvalue().splitlines()[:2], [
+            'line,query,value,probability,error',
+            '1,"P(B|J=t,M=t)","A=t,B=f,E=f",0.30138246147957953,'])
+
+    def test_learn0(self):
+        data = 'A,B,C,D,E,Other\n' + 't,f,t,f,t,x\n' * 3 + 'f,t,f,true,0,y\n' + 'f,f,t,F,1,z\n'
+        net = Net('ex2.bn')
+        self.assertEqual(net.learn(io.StringIO(data)), 5)
+        np.testing.assert_allclose(net.net['A']['cpt'], [0.4, 0.6])
+        np.testing.assert_allclose(net.net['C']['cpt'], [[0.5, 0.5], [0.0, 1.0]])
+        # no data for A=t, B=t
+        np.testing.assert_allclose(net.net['D']['cpt'], [[[1.0, 0.0], [0.0, 1.0]], [[1.0, 0.0], [0.5, 0.5]]])
+        laplace = Net('ex2.bn')
+        laplace.learn(io.StringIO(data), alpha=1, chunksize=2)
+        np.testing.assert_allclose(laplace.net['C']['cpt'], [[0.5, 0.5], [0.2, 0.8]])
+        np.testing.assert_allclose(laplace.net['D']['cpt'], [[[2 / 3.0, 1 / 3.0], [1 / 3.0, 2 / 3.0]], [[0.8, 0.2], [0.5, 0.5]]])
+        written = Net(None)
+        written.read(io.StringIO(laplace.dumps()))
+        np.testing.assert_allclose(written.net['D']['cpt'], laplace.net['D']['cpt'])
+        with self.assertRaises(ValueError):
+            net.learn(io.StringIO('A,B,C,D\nt,t,t,t\n'))
+        with self.assertRaises(ValueError):
+            net.learn(io.StringIO('A,B,C,D,E\nt,t,t,t,maybe\n'))
+        with self.assertRaises(ValueError):
+            net.learn(io.StringIO('A,B,C,D,E\n'))
+        with self.assertRaises(ValueError):
+            net.learn(io.StringIO('A,B,C,D,E\n' + 't,t,t,t,t\n' * 3 + 'f,f,f,f,f\n'), alpha=-0.5)
+        np.testing.assert_allclose(net.net['A']['cpt'], [0.4, 0.6])
+
+        # the distribution of samples of the network is learned back
+        samples = self.net_ex3.prior_sample(20000, seed=1)
+        names = sorted(samples)
+        lines = [','.join(names)] + [','.join(row) for row in zip(*(np.array(self.net_ex3.net[v]['states'])[samples[v]] for v in names))]
+        learned = Net('ex3.bn')
+        learned.learn(io.StringIO('\n'.join(lines) + '\n'), chunksize=3000)
+        for v in names:
+            np.testing.assert_allclose(learned.net[v]['cpt'], self.net_ex3.net[v]['cpt'], atol=0.05)
+
     def test_alarm_ask1(self):
         inputs = [
             ('B', {'J': False, 'M': True}),
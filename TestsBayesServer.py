@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import unittest, os, json, asyncio, tempfile
+from BayesServer import BayesServer, NetCache
+
+class TestBayesServer(unittest.TestCase):
+    def setUp(self):
+        self.server = BayesServer(NetCache('.'))
+
+    def post(self, requests):
+        # post the requests on one connection, concurrently with another
+        async def run():
+            listener = await self.server.start(port=0)
+            port = listener.sockets[0].getsockname()[1]
+            async def client(requests):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                responses = []
+                for request in requests:
+                    body = json.dumps(request).encode()
+                    writer.write(b'POST /query HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+                    status = int((await reader.readline()).split()[1])
+                    length = 0
+                    while True:
+                        line = (await reader.readline()).strip()
+                        if not line:
+                            break
+                        if line.lower().startswith(b'content-length:'):
+                            length = int(line.split(b':')[1])
+                    responses.append((status, json.loads(await reader.readexactly(length))))
+                writer.close()
+                return responses
+            async with listener:
+                return await asyncio.gather(client(requests), client(requests))
+        return asyncio.run(run())
+
+    def test_serve0(self):
+        requests = [
+            {'net': 'alarm.bn', 'query': 'P(B|J=t,M=t)'},
+            {'net': 'alarm.bn', 'alg': 'enum', 'query': 'P(B|J=t,M=t)'},
+            {'net': 'ex3.bn', 'query': 'P(Late)'},
+            {'net': 'alarm.bn', 'query': 'P(X|J=t)'},
+            {'net': '../alarm.bn', 'query': 'P(B)'}
+        ]
+        for responses in self.post(requests):
+            self.assertEqual([s for s, _ in responses], [200, 200, 200, 400, 400])
+            self.assertAlmostEqual(responses[0][1]['distribution']['t'], 0.2842, places=4)
+            self.assertAlmostEqual(responses[1][1]['distribution']['t'], 0.2842, places=4)
+            self.assertAlmostEqual(responses[2][1]['distribution']['f'], 0.7202, places=4)
+            self.assertTrue(responses[1][1]['warm'])
+            self.assertGreater(responses[0][1]['latency'], 0)
+        stats = self.server.stats()
+        self.assertEqual(stats['queries'], 6)
+        self.assertEqual(stats['errors'], 4)
+        self.assertEqual(stats['nets'], 2)
+
+    def test_serve1(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'zero.bn'), 'w') as f:
+                f.write('P(A) = 0.0\n\nA | B\n-----\nt | 0.5\nf | 0.5\n')
+            server = BayesServer(NetCache(root))
+            body = json.dumps({'net': 'zero.bn', 'alg': 'enum', 'query': 'P(B|A=t)'})
+            status, response = asyncio.run(server.respond('POST', '/query', body))
+        self.assertEqual(status, 500)
+        self.assertIn('ZeroDivisionError', response['error'])
+        self.assertEqual(server.stats()['errors'], 1)
+
+    def test_serve2(self):
+        # the query forms of the command line
+        requests = [
+            {'net': 'alarm.bn', 'alg': 'mpe', 'query': 'P(*|J=t,M=t)'},
+            {'net': 'alarm.bn', 'alg': 'map', 'query': 'P(B,E|J=t,M=t)'},
+            {'net': 'alarm.bn', 'query': 'P(A,B|J=t)'}
+        ]
+        responses = [asyncio.run(self.server.respond('POST', '/query', json.dumps(r))) for r in requests]
+        self.assertEqual([s for s, _ in responses], [200, 200, 200])
+        self.assertEqual(responses[0][1]['assignment'], {'A': 't', 'B': 'f', 'E': 'f'})
+        self.assertAlmostEqual(responses[0][1]['probability'], 0.3014, places=4)
+        self.assertAlmostEqual(responses[1][1]['probability'], 0.5403, places=4)
+        self.assertAlmostEqual(responses[2][1]['distribution']['t,t'], 0.0162, places=4)
+
+    def test_netcache0(self):
+        cache = NetCache('.', maxnets=1)
+        net, warm = cache.get('alarm.bn')
+        self.assertFalse(warm)
+        self.assertEqual(cache.get('alarm.bn'), (net, True))
+        cache.get('ex2.bn')
+        self.assertEqual(len(cache.nets), 1)
+        self.assertFalse(cache.get('alarm.bn')[1])
+
+if __name__ == '__main__':
+    unittest.main()
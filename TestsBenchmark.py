@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import unittest
+from BayesNet import Net
+from Benchmark import randomnet, randomqueries, benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def test_randomnet0(self):
+        net = Net(None)
+        net.read(randomnet(50, indegree=2, width=4, states=3, seed=1).splitlines(True))
+        self.assertEqual(len(net.net), 50)
+        names = net.toposort()
+        self.assertEqual(names, sorted(names))
+        for i, v in enumerate(names):
+            self.assertLessEqual(len(net.net[v]['parents']), 2)
+            self.assertTrue(all(names.index(p) >= i - 4 for p in net.net[v]['parents']))
+            self.assertEqual(net.net[v]['states'], ['s0', 's1', 's2'])
+        self.assertEqual(randomnet(20, seed=2), randomnet(20, seed=2))
+        for X, e in randomqueries(net, 5, 3, seed=0):
+            self.assertEqual(len(e), 3)
+            self.assertNotIn(X, e)
+
+    def test_benchmark0(self):
+        res = benchmark(20, queries=3, engines=['init', 'enum', 'elim'])
+        self.assertEqual(sorted(res), ['elim', 'enum', 'init'])
+        self.assertEqual(res['elim']['runs'], 3)
+        self.assertLessEqual(res['elim']['p50'], res['elim']['max'])
+        self.assertGreater(res['init']['peakmemory'], 0)
+        self.assertNotIn('enum', benchmark(20, queries=1, engines=['enum'], enumlimit=10))
+
+if __name__ == '__main__':
+    unittest.main()